@@ -13,7 +13,8 @@ from alembic import context
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 # Импортируем наши модели и настройки из пакета 'src'.
 from src.models import Base
-from src.settings import settings
+from src.settings import get_settings
+settings = get_settings()
 # --- Конец правок ---
 
 # this is the Alembic Config object, which provides
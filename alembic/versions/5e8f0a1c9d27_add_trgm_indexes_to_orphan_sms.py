@@ -0,0 +1,32 @@
+"""add_trgm_indexes_to_orphan_sms
+
+Revision ID: 5e8f0a1c9d27
+Revises: c41d7e9a2b10
+Create Date: 2025-09-20 12:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e8f0a1c9d27'
+down_revision: Union[str, Sequence[str], None] = 'c41d7e9a2b10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # gin_trgm_ops живёт в расширении pg_trgm
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('ix_orphan_source_addr_gin', 'orphan_sms', ['source_addr'], unique=False, postgresql_using='gin', postgresql_ops={'source_addr': 'gin_trgm_ops'})
+    op.create_index('ix_orphan_phone_number_str_gin', 'orphan_sms', ['phone_number_str'], unique=False, postgresql_using='gin', postgresql_ops={'phone_number_str': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_orphan_phone_number_str_gin', table_name='orphan_sms', postgresql_using='gin', postgresql_ops={'phone_number_str': 'gin_trgm_ops'})
+    op.drop_index('ix_orphan_source_addr_gin', table_name='orphan_sms', postgresql_using='gin', postgresql_ops={'source_addr': 'gin_trgm_ops'})
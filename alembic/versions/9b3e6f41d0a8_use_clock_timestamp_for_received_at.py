@@ -0,0 +1,31 @@
+"""use_clock_timestamp_for_received_at
+
+Revision ID: 9b3e6f41d0a8
+Revises: 5e8f0a1c9d27
+Create Date: 2025-09-20 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b3e6f41d0a8'
+down_revision: Union[str, Sequence[str], None] = '5e8f0a1c9d27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # now() = время начала транзакции; clock_timestamp() различает строки пакетной вставки
+    op.alter_column('sms_messages', 'received_at', server_default=sa.text('clock_timestamp()'))
+    op.alter_column('orphan_sms', 'received_at', server_default=sa.text('clock_timestamp()'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.alter_column('orphan_sms', 'received_at', server_default=sa.text('now()'))
+    op.alter_column('sms_messages', 'received_at', server_default=sa.text('now()'))
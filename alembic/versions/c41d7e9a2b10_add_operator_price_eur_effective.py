@@ -0,0 +1,40 @@
+"""add_operator_price_eur_effective
+
+Revision ID: c41d7e9a2b10
+Revises: 3a515f2b79db
+Create Date: 2025-09-20 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41d7e9a2b10'
+down_revision: Union[str, Sequence[str], None] = '3a515f2b79db'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Генерируемая колонка: итоговая цена в евро (для GROUP BY в отчёте по выручке)
+    op.add_column(
+        'operators',
+        sa.Column(
+            'price_eur_effective',
+            sa.Numeric(10, 5),
+            sa.Computed("COALESCE(price_eur, price_eur_cent::numeric(10,5) / 100)", persisted=True),
+            nullable=True,
+            comment="Итоговая цена за 1 SMS в евро (GENERATED ALWAYS AS ... STORED)",
+        ),
+    )
+    op.create_index('ix_operator_provider_price', 'operators', ['provider_id', 'price_eur_effective'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_operator_provider_price', table_name='operators')
+    op.drop_column('operators', 'price_eur_effective')
@@ -0,0 +1,28 @@
+"""add_operator_provider_name_index
+
+Revision ID: e2a7c5b8f316
+Revises: 9b3e6f41d0a8
+Create Date: 2025-09-20 13:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a7c5b8f316'
+down_revision: Union[str, Sequence[str], None] = '9b3e6f41d0a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_operator_provider_name', 'operators', ['provider_id', 'name'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_operator_provider_name', table_name='operators')
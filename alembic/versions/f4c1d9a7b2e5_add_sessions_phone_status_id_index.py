@@ -0,0 +1,28 @@
+"""add_sessions_phone_status_id_index
+
+Revision ID: f4c1d9a7b2e5
+Revises: e2a7c5b8f316
+Create Date: 2025-09-21 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4c1d9a7b2e5'
+down_revision: Union[str, Sequence[str], None] = 'e2a7c5b8f316'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_sessions_phone_status_id', 'sessions', ['phone_number_str', 'status', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sessions_phone_status_id', table_name='sessions')
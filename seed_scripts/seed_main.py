@@ -5,16 +5,9 @@ sys.path.append('.')
 import json
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from pydantic_settings import BaseSettings, SettingsConfigDict
+from src.settings import get_settings
 
-class SeedSettings(BaseSettings):
-    DB_USER: str; DB_PASSWORD: str; DB_NAME: str; DB_HOST: str = "db"
-    @property
-    def DATABASE_URL(self) -> str:
-        return f"postgresql+psycopg://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}/{self.DB_NAME}"
-    model_config = SettingsConfigDict(env_file='.env')
-
-settings = SeedSettings()
+settings = get_settings()
 engine = create_engine(settings.DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -9,7 +9,9 @@ from sqlalchemy import create_engine, event
 from sqlalchemy.engine import URL
 from sqlalchemy.orm import sessionmaker
 
-from src.settings import settings  # читаем значения из .env
+from src.settings import get_settings  # читаем значения из .env
+
+settings = get_settings()
 
 # ---------- Сборка URL для SQLAlchemy (psycopg3) ----------
 sqlalchemy_url = URL.create(
@@ -35,6 +37,7 @@ engine = create_engine(
     pool_timeout=settings.DB_POOL_TIMEOUT,  # сек ждать свободный коннект
     pool_recycle=settings.DB_POOL_RECYCLE,  # сек до принудительного recycle
     pool_pre_ping=True,                     # чинит «мертвые» коннекты
+    pool_use_lifo=True,                     # LIFO: горячие коннекты переиспользуются, лишние добегают до recycle
     echo=settings.LOG_SQL,                  # подробный SQL (для отладки)
     connect_args=connect_args,
     future=True,
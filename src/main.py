@@ -20,7 +20,7 @@ from typing import Optional, List, Dict, Tuple, Callable, Any # ДОБАВЛЕН
 from fastapi import Depends, FastAPI, Request, HTTPException, APIRouter, Query
 from fastapi.responses import StreamingResponse, Response, RedirectResponse
 from sqlalchemy import func, text
-from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm import Session, joinedload, selectinload
 from starlette.responses import JSONResponse
 from starlette_admin.contrib.sqla import Admin, ModelView
 from starlette_admin.auth import AuthProvider
@@ -757,8 +757,9 @@ async def handle_api(
                 return Response("BAD_ACTION", media_type="text/plain")
             sess = (
                 db.query(models.Session)
-                .options(selectinload(models.Session.phone_number),
-                         selectinload(models.Session.service))
+                # to-one: номер одним JOIN; сервис не грузим — нужен только service_id
+                # (а загрузка Service тянула бы ещё и service_limits, lazy="selectin")
+                .options(joinedload(models.Session.phone_number))
                 .filter(models.Session.id == id, models.Session.api_key_id == api_key_obj.id)
                 .first()
             )
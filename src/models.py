@@ -11,6 +11,17 @@ from starlette.requests import Request
 Base = declarative_base()
 
 
+def trgm_index(name: str, col: str, n: int = 256) -> Index:
+    """
+    GIN-индекс по триграммам на LEFT(col, n) для длинных текстовых колонок.
+    Набор триграмм на строку ограничен n символами, поэтому индекс не раздувается
+    и INSERT/UPDATE пишут меньше в posting-листы GIN.
+    Запрос должен использовать то же выражение: LEFT(col, n) ILIKE '%...%'.
+    """
+    expr = func.left(sa.text(col), n).label(f"{col}_left{n}")
+    return Index(name, expr, postgresql_using='gin', postgresql_ops={expr.name: 'gin_trgm_ops'})
+
+
 class Service(Base):
     __tablename__ = 'services'
     id = Column(Integer, primary_key=True)
@@ -75,9 +86,24 @@ class Operator(Base):
     # Новое точное поле в евро (например 0.017):
     price_eur = Column(Numeric(10, 5), nullable=True, comment="Цена за 1 SMS в евро (десятичная)")
 
+    # Итоговая цена (генерируемая колонка Postgres): price_eur, иначе price_eur_cent/100.
+    # Пишет только БД — отчёт по выручке группирует по простой колонке, а не по выражению.
+    price_eur_effective = Column(
+        Numeric(10, 5),
+        sa.Computed("COALESCE(price_eur, price_eur_cent::numeric(10,5) / 100)", persisted=True),
+        nullable=True,
+        comment="Итоговая цена за 1 SMS в евро (GENERATED ALWAYS AS ... STORED)",
+    )
+
     country = relationship("Country", back_populates="operators")
     provider = relationship("Provider", back_populates="operators")
 
+    __table_args__ = (
+        Index('ix_operator_provider_price', 'provider_id', 'price_eur_effective'),
+        # Выпадающий список на /revenue: WHERE provider_id = ? ORDER BY name — без Sort
+        Index('ix_operator_provider_name', 'provider_id', 'name'),
+    )
+
     def __str__(self):
         return self.name
 
@@ -164,6 +190,8 @@ class Session(Base):
     sms_messages = relationship("SmsMessage", back_populates="session", cascade="all, delete-orphan")
     __table_args__ = (
         Index('ix_session_cleanup', 'status', 'created_at'),
+        # поиск активной сессии по входящему SMS: phone IN (...) AND status IN (1,3) ORDER BY id DESC LIMIT 1
+        Index('ix_sessions_phone_status_id', 'phone_number_str', 'status', 'id'),
         Index('idx_sessions_phone_number_id', 'phone_number_id'),
         Index('idx_sessions_service_id', 'service_id'),
     )
@@ -175,7 +203,8 @@ class SmsMessage(Base):
     source_addr = Column(String, nullable=False, index=True)
     text = Column(Text, nullable=False)
     code = Column(String(20), nullable=True, index=True)
-    received_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    # clock_timestamp(), а не now(): у строк из одного multi-row INSERT / одной транзакции разное время
+    received_at = Column(DateTime(timezone=True), server_default=sa.text("clock_timestamp()"), index=True)
     session = relationship("Session", back_populates="sms_messages")
     def __str__(self) -> str:
         return f'{self.text[:50]}...' if len(self.text) > 50 else self.text
@@ -192,6 +221,8 @@ class SmsMessage(Base):
     __table_args__ = (
         Index('idx_sms_session_received', 'session_id', 'received_at'),
         Index('idx_sms_received', 'received_at'),
+        # Поиск по тексту в админке, если понадобится, — только через trgm_index(...),
+        # а не полный GIN по text: trgm_index('ix_sms_messages_text_gin', 'text', 256)
     )
 
 class ApiKey(Base):
@@ -221,7 +252,7 @@ class OrphanSms(Base):
     phone_number_str = Column(String, nullable=False, index=True)
     source_addr = Column(String, nullable=False, index=True)
     text = Column(Text, nullable=False)
-    received_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    received_at = Column(DateTime(timezone=True), server_default=sa.text("clock_timestamp()"), index=True)
     provider_id = Column(Integer, ForeignKey('providers.id', ondelete="SET NULL"), nullable=True, index=True)
     country_id = Column(Integer, ForeignKey('countries.id', ondelete="SET NULL"), nullable=True, index=True)
     operator_id = Column(Integer, ForeignKey('operators.id', ondelete="SET NULL"), nullable=True, index=True)
@@ -233,5 +264,8 @@ class OrphanSms(Base):
         Index('idx_orphan_filters', 'provider_id', 'country_id', 'operator_id', 'received_at'),
         Index('idx_orphan_sender', 'source_addr'),
         Index('idx_orphan_phone', 'phone_number_str'),
+        # Триграммные GIN-индексы под ILIKE '%...%' в админских фильтрах (нужен pg_trgm)
+        Index('ix_orphan_source_addr_gin', 'source_addr', postgresql_using='gin', postgresql_ops={'source_addr': 'gin_trgm_ops'}),
+        Index('ix_orphan_phone_number_str_gin', 'phone_number_str', postgresql_using='gin', postgresql_ops={'phone_number_str': 'gin_trgm_ops'}),
     )
 
@@ -9,7 +9,7 @@ from starlette.templating import Jinja2Templates
 from starlette.responses import StreamingResponse
 
 from sqlalchemy.orm import Session
-from sqlalchemy import func, cast, Numeric
+from sqlalchemy import func, select, lambda_stmt
 
 from .database import SessionLocal
 from . import models
@@ -28,10 +28,10 @@ def _parse_date(s: Optional[str], default_today: bool = False) -> Optional[datet
     if not s:
         return (datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
                 if default_today else None)
-    try:
-        dt = datetime.datetime.fromisoformat(s)
-    except ValueError:
-        dt = datetime.datetime.strptime(s, "%Y-%m-%d")
+    # Быстрый путь для обычного YYYY-MM-DD из формы: без fromisoformat/strptime и исключений
+    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+        return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), tzinfo=datetime.timezone.utc)
+    dt = datetime.datetime.fromisoformat(s)
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=datetime.timezone.utc)
     return dt
@@ -47,9 +47,66 @@ def _parse_int(opt: Optional[str]) -> Optional[int]:
     except Exception:
         return None
 
+# Кванты для quantize создаём один раз, а не на каждый вызов _decimal
+_Q = {"0.01": Decimal("0.01"), "0.00001": Decimal("0.00001")}
+_ZERO = Decimal("0")
+
 def _decimal(val, q: str) -> Decimal:
-    d = Decimal("0") if val is None else (val if isinstance(val, Decimal) else Decimal(str(val)))
-    return d.quantize(Decimal(q), rounding=ROUND_HALF_UP)
+    if val is None:
+        d = _ZERO
+    elif isinstance(val, Decimal):  # обычный случай: Numeric из SQLAlchemy
+        d = val
+    elif isinstance(val, int):
+        d = Decimal(val)
+    else:
+        d = Decimal(str(val))
+    quantum = _Q.get(q) or Decimal(q)
+    return d.quantize(quantum, rounding=ROUND_HALF_UP)
+
+def _amount_cent(price_units: int, sms_cnt: int) -> int:
+    """
+    Сумма в евроцентах в целых числах: цена в 1e-5 € × кол-во SMS,
+    округление до цента ROUND_HALF_UP (как прежний quantize("0.01")).
+    """
+    return (price_units * sms_cnt + 500) // 1000
+
+def _build_revenue_query(
+    start_dt: Optional[datetime.datetime],
+    end_dt: Optional[datetime.datetime],
+    provider_id_int: Optional[int],
+    operator_ids: Optional[List[int]],
+    order_by_count: bool = False,
+):
+    """
+    Запрос выручки по операторам (общий для страницы и CSV).
+    lambda_stmt: SQLAlchemy кэширует построение и компиляцию SQL по «форме» запроса
+    (набору применённых фильтров), значения фильтров уходят bind-параметрами.
+    """
+    # точная цена в евро: генерируемая колонка (price_eur, иначе price_eur_cent/100)
+    stmt = lambda_stmt(lambda: (
+        select(
+            models.Operator.id.label("operator_id"),
+            models.Operator.name.label("operator_name"),
+            models.Operator.price_eur_effective.label("price_eur"),
+            func.count(models.SmsMessage.id).label("sms_count"),
+        )
+        .join(models.PhoneNumber, models.PhoneNumber.operator_id == models.Operator.id)
+        .join(models.Session, models.Session.phone_number_id == models.PhoneNumber.id)
+        .join(models.SmsMessage, models.SmsMessage.session_id == models.Session.id)
+    ))
+    if start_dt:
+        stmt += lambda s: s.where(models.SmsMessage.received_at >= start_dt)
+    if end_dt:
+        stmt += lambda s: s.where(models.SmsMessage.received_at < end_dt)
+    if provider_id_int:
+        stmt += lambda s: s.where(models.Operator.provider_id == provider_id_int)
+    if operator_ids:
+        stmt += lambda s: s.where(models.Operator.id.in_(operator_ids))
+    # GROUP BY только по PK: name и цена функционально зависят от operators.id (Postgres это допускает)
+    stmt += lambda s: s.group_by(models.Operator.id)
+    if order_by_count:
+        stmt += lambda s: s.order_by(func.count(models.SmsMessage.id).desc())
+    return stmt
 
 @router.get("/revenue", tags=["Revenue"], summary="Отчёт по выручке")
 def revenue_page(
@@ -77,52 +134,26 @@ def revenue_page(
         ops_q = ops_q.filter(models.Operator.provider_id == provider_id_int)
     operators = ops_q.order_by(models.Operator.name).all()
 
-    # точная цена в евро: берем price_eur, иначе price_eur_cent/100 как NUMERIC(10,5)
-    price_eur_expr = func.coalesce(
-        models.Operator.price_eur,
-        (cast(models.Operator.price_eur_cent, Numeric(10, 5)) / 100)
-    )
-
-    q = (
-        db.query(
-            models.Operator.id.label("operator_id"),
-            models.Operator.name.label("operator_name"),
-            price_eur_expr.label("price_eur"),
-            func.count(models.SmsMessage.id).label("sms_count"),
-        )
-        .join(models.PhoneNumber, models.PhoneNumber.operator_id == models.Operator.id)
-        .join(models.Session, models.Session.phone_number_id == models.PhoneNumber.id)
-        .join(models.SmsMessage, models.SmsMessage.session_id == models.Session.id)
-    )
-    if start_dt:
-        q = q.filter(models.SmsMessage.received_at >= start_dt)
-    if end_dt:
-        q = q.filter(models.SmsMessage.received_at < end_dt)
-    if provider_id_int:
-        q = q.filter(models.Operator.provider_id == provider_id_int)
-    if operator_ids:
-        q = q.filter(models.Operator.id.in_(operator_ids))
-
-    q = q.group_by(models.Operator.id, models.Operator.name, price_eur_expr)\
-         .order_by(func.count(models.SmsMessage.id).desc())
-    rows = q.all()
+    stmt = _build_revenue_query(start_dt, end_dt, provider_id_int, operator_ids, order_by_count=True)
+    # Core + mappings(): plain dict-строки без ORM Row-обёрток, выборка порциями
+    rows = db.execute(stmt, execution_options={"yield_per": 1000}).mappings()
 
     table = []
     total_sms = 0
-    total_eur = Decimal("0.00")
+    total_cent = 0
     for r in rows:
-        sms_cnt = int(r.sms_count or 0)
-        price_eur = _decimal(r.price_eur, "0.00001")     # 5 знаков для цены
-        amount_eur = _decimal(price_eur * Decimal(sms_cnt), "0.01")  # 2 знака для суммы
+        sms_cnt = int(r["sms_count"] or 0)
+        price_eur = _decimal(r["price_eur"], "0.00001")     # 5 знаков для цены
+        amount_cent = _amount_cent(int(price_eur.scaleb(5)), sms_cnt)  # целые центы
         table.append({
-            "operator_id": r.operator_id,
-            "operator_name": r.operator_name,
+            "operator_id": r["operator_id"],
+            "operator_name": r["operator_name"],
             "price_eur": price_eur,
             "sms_count": sms_cnt,
-            "amount_eur": amount_eur,
+            "amount_eur": Decimal(amount_cent).scaleb(-2),
         })
         total_sms += sms_cnt
-        total_eur += amount_eur
+        total_cent += amount_cent
 
     context = {
         "request": request,
@@ -134,7 +165,7 @@ def revenue_page(
         "end_date_str": (end_dt.date().isoformat() if end_dt else ""),
         "rows": table,
         "total_sms": total_sms,
-        "total_eur": _decimal(total_eur, "0.01"),
+        "total_eur": Decimal(total_cent).scaleb(-2),
     }
     return templates.TemplateResponse("revenue.html", context)
 
@@ -150,40 +181,17 @@ def revenue_export(
     end_dt   = _parse_date(end_date_str)
     provider_id_int = _parse_int(provider_id)
 
-    price_eur_expr = func.coalesce(
-        models.Operator.price_eur,
-        (cast(models.Operator.price_eur_cent, Numeric(10, 5)) / 100)
-    )
-
-    q = (
-        db.query(
-            models.Operator.id.label("operator_id"),
-            models.Operator.name.label("operator_name"),
-            price_eur_expr.label("price_eur"),
-            func.count(models.SmsMessage.id).label("sms_count"),
-        )
-        .join(models.PhoneNumber, models.PhoneNumber.operator_id == models.Operator.id)
-        .join(models.Session, models.Session.phone_number_id == models.PhoneNumber.id)
-        .join(models.SmsMessage, models.SmsMessage.session_id == models.Session.id)
-    )
-    if start_dt:
-        q = q.filter(models.SmsMessage.received_at >= start_dt)
-    if end_dt:
-        q = q.filter(models.SmsMessage.received_at < end_dt)
-    if provider_id_int:
-        q = q.filter(models.Operator.provider_id == provider_id_int)
-    if operator_ids:
-        q = q.filter(models.Operator.id.in_(operator_ids))
-    q = q.group_by(models.Operator.id, models.Operator.name, price_eur_expr)
+    stmt = _build_revenue_query(start_dt, end_dt, provider_id_int, operator_ids)
 
     buf = io.StringIO()
     w = csv.writer(buf)
     w.writerow(["operator_id", "operator_name", "price_eur", "sms_count", "amount_eur"])
-    for r in q.all():
-        sms_cnt = int(r.sms_count or 0)
-        price_eur = _decimal(r.price_eur, "0.00001")
-        amount_eur = _decimal(price_eur * Decimal(sms_cnt), "0.01")
-        w.writerow([r.operator_id, r.operator_name, f"{price_eur:.5f}", sms_cnt, f"{amount_eur:.2f}"])
+    for r in db.execute(stmt, execution_options={"yield_per": 1000}).mappings():
+        sms_cnt = int(r["sms_count"] or 0)
+        price_eur = _decimal(r["price_eur"], "0.00001")
+        amount_cent = _amount_cent(int(price_eur.scaleb(5)), sms_cnt)
+        w.writerow([r["operator_id"], r["operator_name"], f"{price_eur:.5f}", sms_cnt,
+                    f"{amount_cent // 100}.{amount_cent % 100:02d}"])
     buf.seek(0)
 
     fname = f"revenue_{(start_dt.date().isoformat() if start_dt else 'all')}_to_{(end_dt.date().isoformat() if end_dt else 'now')}.csv"
@@ -2,12 +2,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import ipaddress
 import json
-from typing import List
+import re
+from bisect import bisect_right
+from functools import cached_property, lru_cache
+from typing import Any, Dict, List, Tuple, Union
 from urllib.parse import quote_plus
 
+from pydantic import PrivateAttr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+try:
+    import orjson  # type: ignore
+    _json_loads = orjson.loads
+except ImportError:  # orjson необязателен
+    _json_loads = json.loads
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# Разделитель CSV-списков в .env: запятая или точка с запятой (пробелы вокруг съедаются)
+_LIST_SEP_RE = re.compile(r"\s*[;,]\s*")
+
 
 class Settings(BaseSettings):
     """
@@ -55,10 +71,11 @@ class Settings(BaseSettings):
     SMPP_WHITELIST_REFRESH_SECONDS: int = 60     # TTL кэша whitelist’а в секундах
 
     # --- Производные свойства/утилиты ---
-    @property
-    def DATABASE_URL(self) -> str:
+    _database_url: str = PrivateAttr(default="")
+
+    def model_post_init(self, __context: Any) -> None:
         """
-        Собираем URL для SQLAlchemy с драйвером psycopg (psycopg3).
+        Собираем URL для SQLAlchemy с драйвером psycopg (psycopg3) один раз при создании.
         Все части аккуратно экранируем.
         """
         user = quote_plus((self.DB_USER or "").strip())
@@ -66,12 +83,17 @@ class Settings(BaseSettings):
         host = (self.DB_HOST or "").strip()
         db = (self.DB_NAME or "").strip()
         port = int(self.DB_PORT) if str(self.DB_PORT).strip() else 5432
-        return f"postgresql+psycopg://{user}:{pwd}@{host}:{port}/{db}"
+        self._database_url = f"postgresql+psycopg://{user}:{pwd}@{host}:{port}/{db}"
 
-    def get_allowed_smpp_ips(self) -> List[str]:
+    @property
+    def DATABASE_URL(self) -> str:
+        return self._database_url
+
+    @cached_property
+    def allowed_smpp_ips(self) -> List[str]:
         """
         Разобрать ALLOWED_SMPP_IPS_RAW в список строк (IP/CIDR).
-        Поддерживает JSON-массив и CSV/«;».
+        Поддерживает JSON-массив и CSV/«;». Разбор — один раз на процесс.
         """
         raw = (self.ALLOWED_SMPP_IPS_RAW or "").strip()
         if not raw:
@@ -79,46 +101,99 @@ class Settings(BaseSettings):
         # JSON-массив
         if raw.startswith("["):
             try:
-                arr = json.loads(raw)
+                arr = _json_loads(raw)
                 return [str(x).strip() for x in arr if str(x).strip()]
             except Exception:
                 pass
         # CSV/semicolon
-        parts = raw.replace(";", ",").split(",")
-        return [p.strip() for p in parts if p.strip()]
+        return [p for p in _LIST_SEP_RE.split(raw) if p]
 
-    def get_smpp_bind_ports(self) -> List[int]:
+    @cached_property
+    def smpp_bind_ports(self) -> List[int]:
         """
-        Вернуть список портов для прослушивания SMPP.
+        Список портов для прослушивания SMPP (разбирается один раз на процесс).
         Приоритет: SMPP_BIND_PORTS_RAW -> одиночный SMPP_BIND_PORT.
         """
         raw = (self.SMPP_BIND_PORTS_RAW or "").strip()
         if not raw:
             return [int(self.SMPP_BIND_PORT)]
         ports: List[int] = []
-        # JSON-массив
+        # JSON-массив: битый JSON — ошибка конфигурации, а не повод разбирать его как CSV
         if raw.startswith("["):
             try:
-                arr = json.loads(raw)
-                for x in arr:
-                    try:
-                        ports.append(int(str(x).strip()))
-                    except Exception:
-                        pass
-                return sorted(set(ports)) or [int(self.SMPP_BIND_PORT)]
-            except Exception:
-                pass
+                arr = _json_loads(raw)
+            except ValueError as e:
+                raise ValueError(f"SMPP_BIND_PORTS_RAW: некорректный JSON-массив: {e}") from e
+            for x in arr:
+                try:
+                    ports.append(int(str(x).strip()))
+                except Exception:
+                    pass
+            return sorted(set(ports)) or [int(self.SMPP_BIND_PORT)]
         # CSV/semicolon
-        for item in raw.replace(";", ",").split(","):
-            item = item.strip()
-            if not item:
-                continue
+        for item in _LIST_SEP_RE.split(raw):
             try:
                 ports.append(int(item))
-            except Exception:
+            except ValueError:  # пустой/нечисловой элемент пропускаем
                 pass
         return sorted(set(ports)) or [int(self.SMPP_BIND_PORT)]
 
+    @cached_property
+    def allowed_smpp_networks(self) -> List[IPNetwork]:
+        """
+        Статический whitelist как сети: распарсен один раз, пересекающиеся
+        диапазоны слиты (collapse_addresses), внутри версии IP — по возрастанию.
+        """
+        v4: List[IPNetwork] = []
+        v6: List[IPNetwork] = []
+        for item in self.allowed_smpp_ips:
+            try:
+                net = ipaddress.ip_network(item, strict=False)
+            except ValueError:
+                continue
+            (v4 if net.version == 4 else v6).append(net)
+        return [*ipaddress.collapse_addresses(v4), *ipaddress.collapse_addresses(v6)]
+
+    @cached_property
+    def allowed_smpp_index(self) -> Dict[int, Tuple[List[int], List[int]]]:
+        """Версия IP -> (начала, концы) сетей как int: параллельные списки для bisect."""
+        index: Dict[int, Tuple[List[int], List[int]]] = {}
+        for net in self.allowed_smpp_networks:
+            lows, highs = index.setdefault(net.version, ([], []))
+            lows.append(int(net.network_address))
+            highs.append(int(net.broadcast_address))
+        return index
+
+    def is_smpp_ip_allowed(self, ip: Union[str, ipaddress.IPv4Address, ipaddress.IPv6Address]) -> bool:
+        """
+        Проверка IP по статическому whitelist за O(log N):
+        bisect по началам сетей + одно сравнение int с концом (без ipaddress.__contains__).
+        Сети после collapse не пересекаются, поэтому кандидат ровно один.
+        Принимает и уже разобранный адрес — без повторного парсинга строки.
+        """
+        if isinstance(ip, str):
+            try:
+                addr = ipaddress.ip_address(ip)
+            except ValueError:
+                return False
+        else:
+            addr = ip
+        entry = self.allowed_smpp_index.get(addr.version)
+        if not entry:
+            return False
+        lows, highs = entry
+        a = int(addr)
+        i = bisect_right(lows, a) - 1
+        return i >= 0 and a <= highs[i]
+
+    def get_allowed_smpp_ips(self) -> List[str]:
+        """Совместимость: копия закэшированного списка IP/CIDR."""
+        return list(self.allowed_smpp_ips)
+
+    def get_smpp_bind_ports(self) -> List[int]:
+        """Совместимость: копия закэшированного списка портов."""
+        return list(self.smpp_bind_ports)
+
     # Pydantic Settings конфигурация: читаем .env и игнорируем лишние переменные
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -127,5 +202,11 @@ class Settings(BaseSettings):
     )
 
 
-# Единый инстанс настроек
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Единый инстанс настроек на процесс: .env читается и валидируется один раз."""
+    return Settings()
+
+
+# Совместимость со старым импортом `from src.settings import settings`
+settings = get_settings()
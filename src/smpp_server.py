@@ -4,25 +4,44 @@ from __future__ import annotations
 
 import os
 import asyncio
+import bisect
+import functools
 import struct
-import random
+import itertools
 import ipaddress
 import logging
+import re
+import socket
+import threading
 import time
-from typing import Iterable, List, Optional, Set, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from sqlalchemy import text
 from smpplib import smpp, pdu
 
-from src.database import SessionLocal
+# --- optional pytricia (C-trie для whitelist; без него — bisect по диапазонам) ---
+try:
+    import pytricia  # type: ignore
+except Exception:
+    pytricia = None  # type: ignore
+
+# Пул БД (src/database.py): pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pre_ping, LIFO, recycle.
+# Здесь: одна ORM-сессия на SMPP-соединение (коннект берётся только на время транзакции PDU),
+# а одновременная работа с БД ограничена DB_POOL = pool_size потоков — тысячи соединений
+# не выбирают пул до overflow; сверху только редкие перечитывания whitelist/индекса провайдеров.
+from src.database import SessionLocal, engine
 from src import models
 from src.smpp_worker import (
-    _handle_deliver_sm, get_decoded_text,
+    _handle_deliver_sm,
     start_concatenation_worker, stop_concatenation_worker,
     run_smpp_provider_loop, ESME_ROK, ESME_RSUBMITFAIL, ESME_RSYSERR,
 )
 from src.logging_setup import ConnAdapter
-from src.settings import settings
+from src.settings import get_settings
+
+settings = get_settings()
 
 # --------- logging ----------
 try:
@@ -49,19 +68,25 @@ class SequenceGenerator:
         return cur
 
 # ---------------- Whitelist helpers ----------------
+_CIDR_TOKEN_RE = re.compile(r"[^,;\s]+")
+
 def _parse_cidrs(raw: str) -> List[ipaddress._BaseNetwork]:
     nets: List[ipaddress._BaseNetwork] = []
-    for token in (raw or "").replace(";", ",").split(","):
-        token = token.strip()
-        if not token:
-            continue
+    for m in _CIDR_TOKEN_RE.finditer(raw or ""):
+        token = m.group()
         try:
-            if "/" not in token:
-                ip = ipaddress.ip_address(token)
-                token = f"{token}/32" if isinstance(ip, ipaddress.IPv4Address) else f"{token}/128"
-            nets.append(ipaddress.ip_network(token, strict=False))
-        except ValueError:
-            log.debug(f"[yellow]WHITELIST ENV[/]: игнор '{token}'")
+            if "/" in token:
+                nets.append(ipaddress.ip_network(token, strict=False))
+                continue
+            parts = token.split(".")
+            if len(parts) == 4 and all(p.isdigit() for p in parts):
+                # одиночный IPv4: сеть /32 строим из int, без разбора строки в ipaddress
+                a = int.from_bytes(socket.inet_aton(token), "big")
+                nets.append(ipaddress.IPv4Network((a, 32)))
+            else:
+                nets.append(ipaddress.ip_network(token, strict=False))
+        except (ValueError, OSError):
+            log.debug("[yellow]WHITELIST ENV[/]: игнор '%s'", token)
     return nets
 
 def _extract_ipv4_from_host(host: str) -> Optional[str]:
@@ -70,114 +95,290 @@ def _extract_ipv4_from_host(host: str) -> Optional[str]:
         return None
     if ":" in host:
         host = host.split(":", 1)[0].strip()
+    # имена хостов отсекаем строковой проверкой, без исключения из ipaddress
+    parts = host.split(".")
+    if len(parts) != 4 or not all(p.isdigit() for p in parts):
+        return None
     try:
         ipaddress.ip_address(host)
         return host
     except ValueError:
         return None
 
-def _load_whitelist_from_env() -> List[ipaddress._BaseNetwork]:
-    raw = settings.ALLOWED_SMPP_IPS_RAW or os.getenv("ALLOWED_SMPP_IPS", "")
-    nets = _parse_cidrs(raw)
+@functools.lru_cache(maxsize=1)
+def _load_whitelist_from_env() -> Tuple[ipaddress._BaseNetwork, ...]:
+    # Переменные окружения в процессе не меняются — разбираем их один раз;
+    # TTL-кэш ниже (_WHITELIST_CACHE) перечитывает только БД.
+    if settings.ALLOWED_SMPP_IPS_RAW:
+        nets = list(settings.allowed_smpp_networks)
+    else:
+        nets = _parse_cidrs(os.getenv("ALLOWED_SMPP_IPS", ""))
     if settings.SMPP_WHITELIST_ALLOW_LOCALHOST:
         nets.append(ipaddress.ip_network("127.0.0.1/32"))
         try:
             nets.append(ipaddress.ip_network("::1/128"))
         except Exception:
             pass
-    return nets
+    return tuple(nets)
 
-def _load_whitelist_from_db() -> List[ipaddress._BaseNetwork]:
-    nets: List[ipaddress._BaseNetwork] = []
-    db = SessionLocal()
-    try:
+class _ProviderIpIndex:
+    """
+    Снимок provider_ips (активные CIDR) + providers.smpp_host: IP -> provider_id без запросов в БД.
+    CIDR — longest-prefix match: PyTricia, если установлен, иначе dict по длинам префиксов
+    (проверка = по одному dict-lookup на каждую встреченную длину префикса).
+    При совпадении CIDR у нескольких провайдеров побеждает первый прочитанный, как и раньше.
+    """
+    def __init__(self) -> None:
+        self.networks: List[ipaddress._BaseNetwork] = []  # всё подряд — для whitelist
+        self.host_map: Dict[str, int] = {}
+        self.names: Dict[int, str] = {}  # provider_id -> name (для логов сессии)
+        self._tries = {4: pytricia.PyTricia(32), 6: pytricia.PyTricia(128)} if pytricia is not None else None
+        self._by_len: Dict[int, Dict[int, Dict[int, int]]] = {4: {}, 6: {}}
+        self._lens: Dict[int, List[int]] = {4: [], 6: []}
+
+    def add_network(self, net: ipaddress._BaseNetwork, pid: int) -> None:
+        self.networks.append(net)
+        if self._tries is not None:
+            trie, key = self._tries[net.version], str(net)
+            if not trie.has_key(key):
+                trie[key] = pid
+            return
+        self._by_len[net.version].setdefault(net.prefixlen, {}).setdefault(int(net.network_address), pid)
+
+    def add_host(self, ip: str, pid: int) -> None:
+        addr = ipaddress.ip_address(ip)
+        self.networks.append(ipaddress.ip_network(f"{addr}/{addr.max_prefixlen}"))
+        self.host_map.setdefault(str(addr), pid)
+
+    def finalize(self) -> "_ProviderIpIndex":
+        self._lens = {v: sorted(d, reverse=True) for v, d in self._by_len.items()}
+        return self
+
+    def resolve(self, ip) -> Optional[int]:
+        """Сначала CIDR из provider_ips (самый длинный префикс), затем точный smpp_host."""
         try:
-            rows = db.execute(text(
-                "SELECT ip_cidr FROM provider_ips WHERE is_active = true AND ip_cidr IS NOT NULL AND ip_cidr <> ''"
-            )).fetchall()
-            for (cidr,) in rows:
-                try:
-                    nets.append(ipaddress.ip_network(str(cidr).strip(), strict=False))
-                except Exception:
-                    pass
-        except Exception as e:
-            log.warning(f"[yellow]WHITELIST DB[/]: не прочитал provider_ips: {e}")
+            addr = ip if not isinstance(ip, str) else ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if self._tries is not None:
+            pid = self._tries[addr.version].get(str(addr))
+            if pid is not None:
+                return pid
+        else:
+            a, bits, by_len = int(addr), addr.max_prefixlen, self._by_len[addr.version]
+            for plen in self._lens[addr.version]:
+                mask = ((1 << plen) - 1) << (bits - plen)
+                pid = by_len[plen].get(a & mask)
+                if pid is not None:
+                    return pid
+        return self.host_map.get(str(addr))
+
+# Один round-trip на оба источника: kind = 'c' (CIDR из provider_ips) | 'p' (провайдер)
+_PROVIDER_INDEX_SQL = (
+    "SELECT 'c', provider_id, ip_cidr, NULL FROM provider_ips "
+    "WHERE is_active = true AND ip_cidr IS NOT NULL AND ip_cidr <> '' "
+    "UNION ALL "
+    "SELECT 'p', id, smpp_host, name FROM providers"
+)
 
+def _load_provider_index_from_db() -> _ProviderIpIndex:
+    idx = _ProviderIpIndex()
+    # DBAPI-курсор из пула напрямую: без Session/ORM и Row-объектов на раз в TTL
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
         try:
-            rows2 = db.execute(text(
-                "SELECT smpp_host FROM providers WHERE smpp_host IS NOT NULL AND smpp_host <> ''"
-            )).fetchall()
-            for (host,) in rows2:
-                ip = _extract_ipv4_from_host(host)
-                if ip:
-                    nets.append(ipaddress.ip_network(f"{ip}/32"))
-        except Exception as e:
-            log.warning(f"[yellow]WHITELIST DB[/]: не прочитал providers: {e}")
+            cur.execute(_PROVIDER_INDEX_SQL)
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+    except Exception as e:
+        log.warning("[yellow]WHITELIST DB[/]: не прочитал provider_ips/providers: %s", e)
+        rows = []
     finally:
-        db.close()
-    return nets
+        conn.close()  # вернуть в пул (с rollback)
+
+    for kind, pid, value, name in rows:
+        try:
+            if kind == "c":
+                idx.add_network(ipaddress.ip_network(str(value).strip(), strict=False), int(pid))
+                continue
+            idx.names[int(pid)] = name
+            ip = _extract_ipv4_from_host(value) if value else None
+            if ip:
+                idx.add_host(ip, int(pid))
+        except Exception:
+            pass
+    return idx.finalize()
+
+_PROVIDER_INDEX_CACHE: Tuple[float, Optional[_ProviderIpIndex]] = (0.0, None)
+_PROVIDER_INDEX_LOCK = threading.Lock()
+
+def get_provider_index() -> _ProviderIpIndex:
+    """TTL-кэш индекса (тот же SMPP_WHITELIST_REFRESH_SECONDS); общий для whitelist и RESOLVE."""
+    global _PROVIDER_INDEX_CACHE
+    ttl = max(5, int(settings.SMPP_WHITELIST_REFRESH_SECONDS or 60))
+    ts, cached = _PROVIDER_INDEX_CACHE
+    if cached is not None and time.time() - ts < ttl:
+        return cached
+    # double-checked: при истечении TTL в БД идёт один поток, остальные получают его результат
+    with _PROVIDER_INDEX_LOCK:
+        ts, cached = _PROVIDER_INDEX_CACHE
+        if cached is not None and time.time() - ts < ttl:
+            return cached
+        idx = _load_provider_index_from_db()
+        _PROVIDER_INDEX_CACHE = (time.time(), idx)
+        return idx
+
+def _load_whitelist_from_db() -> List[ipaddress._BaseNetwork]:
+    return list(get_provider_index().networks)
 
 _WHITELIST_CACHE: Tuple[float, List[ipaddress._BaseNetwork]] = (0.0, [])
+_WHITELIST_LOCK = threading.Lock()
+
 def build_effective_whitelist() -> List[ipaddress._BaseNetwork]:
-    now = time.time()
-    ts, cached = _WHITELIST_CACHE
     ttl = max(5, int(settings.SMPP_WHITELIST_REFRESH_SECONDS or 60))
-    if now - ts < ttl and cached:
+    ts, cached = _WHITELIST_CACHE
+    if time.time() - ts < ttl and cached:
         return cached
+    with _WHITELIST_LOCK:
+        ts, cached = _WHITELIST_CACHE
+        if time.time() - ts < ttl and cached:
+            return cached
+        return _rebuild_whitelist()
+
+def _rebuild_whitelist() -> List[ipaddress._BaseNetwork]:
+    global _WHITELIST_CACHE
+    now = time.time()
     env_nets = _load_whitelist_from_env()
     db_nets = _load_whitelist_from_db() if settings.SMPP_WHITELIST_FROM_DB else []
-    seen: Set[str] = set()
+    # ключ дедупликации — числа, без форматирования каждой сети в строку
+    seen: Set[Tuple[int, int, int]] = set()
     result: List[ipaddress._BaseNetwork] = []
-    for n in env_nets + db_nets:
-        s = str(n)
-        if s not in seen:
+    for n in (*env_nets, *db_nets):
+        key = (n.version, int(n.network_address), n.prefixlen)
+        if key not in seen:
             result.append(n)
-            seen.add(s)
-    short = ", ".join(str(n) for n in result[:5]) + ("..." if len(result) > 5 else "")
-    log.info(f"[cyan]WHITELIST[/]: loaded {len(result)} rule(s): {short}")
-    globals()["_WHITELIST_CACHE"] = (now, result)
+            seen.add(key)
+    if log.isEnabledFor(logging.INFO):
+        short = ", ".join(str(n) for n in result[:5]) + ("..." if len(result) > 5 else "")
+        log.info("[cyan]WHITELIST[/]: loaded %d rule(s): %s", len(result), short)
+    _WHITELIST_CACHE = (now, result)
     return result
 
-def is_ip_allowed(ip: str, whitelist: Iterable[ipaddress._BaseNetwork]) -> bool:
-    try:
-        addr = ipaddress.ip_address(ip)
-    except Exception:
+# версия IP -> (начала, концы) непересекающихся диапазонов, по возрастанию
+IpRanges = Dict[int, Tuple[List[int], List[int]]]
+
+# версия IP -> PyTricia (если доступен) или IpRanges-запись
+IpMatcher = Dict[int, Any]
+
+def _networks_to_ranges(nets) -> IpRanges:
+    """Сети -> отсортированные целочисленные диапазоны; вложенные/смежные сливаются."""
+    spans_by_ver: Dict[int, List[Tuple[int, int]]] = {}
+    for n in nets:
+        spans_by_ver.setdefault(n.version, []).append((int(n.network_address), int(n.broadcast_address)))
+    ranges: IpRanges = {}
+    for ver, spans in spans_by_ver.items():
+        spans.sort()
+        starts: List[int] = []
+        ends: List[int] = []
+        for lo, hi in spans:
+            if ends and lo <= ends[-1] + 1:
+                if hi > ends[-1]:
+                    ends[-1] = hi
+            else:
+                starts.append(lo)
+                ends.append(hi)
+        ranges[ver] = (starts, ends)
+    return ranges
+
+def _build_ip_matcher(nets) -> IpMatcher:
+    """PyTricia на каждое семейство адресов, если модуль установлен, иначе целочисленные диапазоны."""
+    if pytricia is None or not nets:
+        return _networks_to_ranges(nets)
+    tries = {4: pytricia.PyTricia(32), 6: pytricia.PyTricia(128)}
+    for n in nets:
+        tries[n.version][str(n)] = True
+    return tries
+
+class _WhitelistCache:
+    """
+    TTL-снимок эффективного whitelist (env + БД): PyTricia или целочисленные диапазоны.
+    Обновляется не чаще раза в SMPP_WHITELIST_REFRESH_SECONDS; загрузка из БД
+    идёт в отдельном потоке, чтобы не блокировать event loop.
+    """
+    def __init__(self) -> None:
+        self.expires_at = 0.0
+        self.matcher: IpMatcher = {}
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> IpMatcher:
+        if time.monotonic() < self.expires_at:
+            return self.matcher
+        async with self._lock:
+            # пока ждали лок, снимок мог обновить соседний accept
+            if time.monotonic() >= self.expires_at:
+                nets = await asyncio.to_thread(build_effective_whitelist)
+                self.matcher = _build_ip_matcher(nets)
+                ttl = max(5, int(settings.SMPP_WHITELIST_REFRESH_SECONDS or 60))
+                self.expires_at = time.monotonic() + ttl
+        return self.matcher
+
+_WL_CACHE = _WhitelistCache()
+
+def _ip_to_int(ip: str) -> Tuple[int, int]:
+    """(версия, адрес как int) через inet_pton — без объектов ipaddress. Невалидный адрес — OSError."""
+    if ":" in ip:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+
+def is_ip_allowed(ip, matcher: IpMatcher) -> bool:
+    """
+    PyTricia: longest-prefix match в C; иначе O(log N) bisect по началам диапазонов.
+    ip — строка или уже разобранный ipaddress-адрес (тогда повторного парсинга нет).
+    Пустой whitelist — сразу отказ, без разбора адреса (как и раньше: пусто = никого не пускаем).
+    """
+    if not matcher:
         return False
-    for net in whitelist:
+    if pytricia is not None:
+        if isinstance(ip, str):
+            trie = matcher.get(6 if ":" in ip else 4)
+        else:
+            trie, ip = matcher.get(ip.version), str(ip)
         try:
-            if addr in net:
-                return True
-        except Exception:
-            pass
-    return False
+            return bool(trie) and ip in trie
+        except (ValueError, KeyError, TypeError):
+            return False
+    if isinstance(ip, str):
+        try:
+            version, a = _ip_to_int(ip)
+        except OSError:
+            return False
+    else:
+        version, a = ip.version, int(ip)
+    entry = matcher.get(version)
+    if not entry:
+        return False
+    starts, ends = entry
+    i = bisect.bisect_right(starts, a) - 1
+    return i >= 0 and a <= ends[i]
 
-def resolve_provider_id_for_ip(db, ip: str) -> Optional[int]:
+def resolve_provider_id_for_ip(ip) -> Optional[int]:
     """Строгое сопоставление: IP ∈ CIDR из provider_ips, затем точное совпадение с providers.smpp_host."""
     try:
-        addr = ipaddress.ip_address(ip)
-        rows = db.execute(text(
-            "SELECT provider_id, ip_cidr FROM provider_ips WHERE is_active = true AND ip_cidr IS NOT NULL AND ip_cidr <> ''"
-        )).fetchall()
-        for pid, cidr in rows:
-            try:
-                net = ipaddress.ip_network(str(cidr).strip(), strict=False)
-                if addr in net:
-                    return int(pid)
-            except Exception:
-                continue
-        rows2 = db.execute(text(
-            "SELECT id, smpp_host FROM providers WHERE smpp_host IS NOT NULL AND smpp_host <> ''"
-        )).fetchall()
-        for pid, host in rows2:
-            h_ip = _extract_ipv4_from_host(host)
-            if h_ip == ip:
-                return int(pid)
+        return get_provider_index().resolve(ip)
     except Exception as e:
-        log.warning(f"[yellow]RESOLVE PROVIDER[/]: ошибка чтения providers: {e}")
+        log.warning("[yellow]RESOLVE PROVIDER[/]: ошибка чтения providers: %s", e)
     return None
 
 # ---------------- SMPP low-level helpers ----------------
 
+# Заголовок PDU: command_length, command_id, command_status, sequence_number
+_PDU_HEADER = struct.Struct(">LLLL")
+_PDU_LEN = struct.Struct(">L")
+_ENQUIRE_LINK_ID = 0x00000015
+_ENQUIRE_LINK_RESP_ID = 0x80000015
+
 # Карта: request command -> response command_id
 RESP_CMD_ID = {
     "bind_transmitter": 0x80000002,
@@ -189,44 +390,64 @@ RESP_CMD_ID = {
     "deliver_sm": 0x80000005,
 }
 
+# message_id для submit_sm_resp: монотонный счётчик процесса. Старт от времени запуска (<<20),
+# поэтому после рестарта id не повторяются (пока в среднем < 1M ответов/сек)
+_MSGID = itertools.count(int(time.time()) << 20)
+
+def _next_message_id() -> bytes:
+    return b"%d" % next(_MSGID)
+
 def _c_octet(b: bytes) -> bytes:
     """C-Octet String: ASCII bytes + NUL."""
+    if isinstance(b, memoryview):
+        b = b.tobytes()
     if not isinstance(b, (bytes, bytearray)):
         b = str(b or "").encode("ascii", "ignore")
     return bytes(b) + b"\x00"
 
+def _empty_resp_body(status: int, message_id: Optional[bytes], system_id: Optional[bytes]) -> bytes:
+    return b""
+
+def _submit_resp_body(status: int, message_id: Optional[bytes], system_id: Optional[bytes]) -> bytes:
+    if status != ESME_ROK:
+        return b""
+    return _c_octet(message_id if message_id is not None else _next_message_id())
+
+def _bind_resp_body(status: int, message_id: Optional[bytes], system_id: Optional[bytes]) -> bytes:
+    return _c_octet(system_id or b"SMSService")
+
+_BIND_CMDS = frozenset(("bind_transceiver", "bind_transmitter", "bind_receiver"))
+
+# request command -> (resp command_id, сборщик тела); один dict-lookup на ответ
+_RESP_BUILDERS = {
+    cmd: (resp_id, _bind_resp_body if cmd in _BIND_CMDS else _submit_resp_body if cmd == "submit_sm" else _empty_resp_body)
+    for cmd, resp_id in RESP_CMD_ID.items()
+}
+# неизвестное — отвечаем generic_nack с пустым телом
+_GENERIC_NACK = (0x80000000, _empty_resp_body)
+
 def make_resp_bytes(req: pdu.PDU, status: int, message_id: Optional[bytes] = None, system_id: Optional[bytes] = None) -> bytes:
     """
     РУЧНАЯ сборка RESP PDU: правильный command_id, тот же sequence, корректный command_status.
-    Для submit_sm_resp при OK добавляем message_id (C-Octet).
+    Для submit_sm_resp при OK добавляем message_id (C-Octet): его генерирует вызывающий
+    (тот же id уходит в DLR); если не передан — берём следующий из _next_message_id().
     Для bind_*_resp добавляем system_id (C-Octet).
     Для остальных — тело пустое.
     """
-    resp_cmd_id = RESP_CMD_ID.get(req.command)
-    if resp_cmd_id is None:
-        # неизвестное — отвечаем generic_nack (0x80000000)
-        resp_cmd_id = 0x80000000
-
+    resp_cmd_id, body_fn = _RESP_BUILDERS.get(req.command, _GENERIC_NACK)
+    body = body_fn(status, message_id, system_id)
     seq = getattr(req, "sequence", 0) or 0
+    return _PDU_HEADER.pack(16 + len(body), resp_cmd_id, status & 0xFFFFFFFF, seq & 0xFFFFFFFF) + body
 
-    body = b""
-    if resp_cmd_id == 0x80000004:  # submit_sm_resp
-        if status == ESME_ROK:
-            if message_id is None:
-                message_id = str(random.randint(10000, 99999)).encode("ascii")
-            body = _c_octet(message_id)
-        else:
-            body = b""
-    elif resp_cmd_id in (0x80000001, 0x80000002, 0x80000009):  # bind_*_resp
-        if not system_id:
-            system_id = b"SMSService"
-        body = _c_octet(system_id)
+# ---------------- DLR helpers ----------------
+# CR/LF -> пробел одним проходом (текст для лога и превью DLR)
+_ONE_LINE = str.maketrans({"\r": " ", "\n": " "})
 
-    length = 16 + len(body)
-    header = struct.pack(">LLLL", length, resp_cmd_id, int(status) & 0xFFFFFFFF, int(seq) & 0xFFFFFFFF)
-    return header + body
+@functools.lru_cache(maxsize=4)
+def _dlr_minute_stamp(minute_epoch: int) -> str:
+    """YYMMDDhhmm (UTC) для минуты minute_epoch; формат DLR поминутный, поэтому кэшируем."""
+    return time.strftime("%y%m%d%H%M", time.gmtime(minute_epoch * 60))
 
-# ---------------- DLR helpers ----------------
 def _dlr_text(message_id: bytes | str, stat: str = "DELIVRD", sample: str = "") -> bytes:
     """
     Стандартный текст DLR (SMPP 3.4): id:... sub:001 dlvrd:001 submit date:YYMMDDhhmm done date:YYMMDDhhmm stat:... err:000 text:...
@@ -235,10 +456,39 @@ def _dlr_text(message_id: bytes | str, stat: str = "DELIVRD", sample: str = "")
         mid = message_id.decode("ascii", "ignore")
     else:
         mid = str(message_id or "")
-    now = time.strftime("%y%m%d%H%M", time.gmtime())
-    preview = (sample or "").replace("\r", " ").replace("\n", " ")[:20]
+    now = _dlr_minute_stamp(int(time.time()) // 60)
+    preview = (sample or "")[:20].translate(_ONE_LINE)
     s = f"id:{mid} sub:001 dlvrd:001 submit date:{now} done date:{now} stat:{stat} err:000 text:{preview}"
-    return s.encode("ascii", "ignore")
+    # isascii() — O(1) флаг строки; обработчик ошибок нужен только для не-ASCII превью
+    return s.encode("ascii") if s.isascii() else s.encode("ascii", "ignore")
+
+_TON_NPI = struct.Struct(">BB")
+_TLV_HDR = struct.Struct(">HH")
+_DELIVER_SM_ID = 0x00000005
+_TLV_RECEIPTED_MESSAGE_ID = 0x001E
+_TLV_MESSAGE_STATE = 0x0427
+# esm_class=0x04 (Delivery Receipt), protocol_id=0, priority_flag=0,
+# schedule_delivery_time="", validity_period="", registered_delivery=0,
+# replace_if_present_flag=0, data_coding=0, sm_default_msg_id=0
+_DLR_FIXED_FIELDS = bytes((0x04, 0, 0, 0, 0, 0, 0, 0, 0))
+
+def _pack_dlr(seq: int, src_ton: int, src_npi: int, src_addr, dst_ton: int, dst_npi: int, dst_addr,
+              short_msg: bytes, rmid) -> bytes:
+    """deliver_sm (DLR) собирается вручную: раскладка фиксирована, smpplib-сериализация не нужна."""
+    short_msg = short_msg[:254]
+    rmid_c = _c_octet(rmid)  # receipted_message_id — C-Octet String по спецификации
+    parts = (
+        b"\x00",  # service_type = ""
+        _TON_NPI.pack(int(src_ton or 0) & 0xFF, int(src_npi or 0) & 0xFF), _c_octet(src_addr),
+        _TON_NPI.pack(int(dst_ton or 0) & 0xFF, int(dst_npi or 0) & 0xFF), _c_octet(dst_addr),
+        _DLR_FIXED_FIELDS,
+        bytes((len(short_msg),)), short_msg,
+        _TLV_HDR.pack(_TLV_RECEIPTED_MESSAGE_ID, len(rmid_c)), rmid_c,
+        _TLV_HDR.pack(_TLV_MESSAGE_STATE, 1), b"\x02",  # message_state = DELIVERED
+    )
+    # длину считаем по частям, а заголовок кладём в тот же join — PDU собирается одной копией
+    header = _PDU_HEADER.pack(16 + sum(map(len, parts)), _DELIVER_SM_ID, ESME_ROK, seq & 0xFFFFFFFF)
+    return b"".join((header, *parts))
 
 def make_dlr_deliver_sm_bytes(req: pdu.PDU, seq_gen: SequenceGenerator, message_id: bytes, stat: str, sample: str) -> bytes:
     """
@@ -246,209 +496,390 @@ def make_dlr_deliver_sm_bytes(req: pdu.PDU, seq_gen: SequenceGenerator, message_
     Источник/получатель меняем местами: src <- destination_addr, dst <- source_addr.
     Добавляем TLV: receipted_message_id, message_state=2 (DELIVERED).
     """
+    # smpplib заводит все параметры submit_sm/data_sm атрибутами (None, если не пришли),
+    # поэтому читаем их напрямую; отсутствие поля ловит общий except ниже
     try:
-        # receipted_message_id должен быть строкой (C-Octet String) по спецификации
-        if isinstance(message_id, (bytes, bytearray)):
-            rmid = message_id.decode("ascii", "ignore")
-        else:
-            rmid = str(message_id or "0")
-
-        dlr_pdu = smpp.make_pdu(
-            "deliver_sm",
-            client=seq_gen,
-            service_type=b"",
-            source_addr_ton=getattr(req, "dest_addr_ton", 0),
-            source_addr_npi=getattr(req, "dest_addr_npi", 0),
-            source_addr=getattr(req, "destination_addr", b""),
-            dest_addr_ton=getattr(req, "source_addr_ton", 0),
-            dest_addr_npi=getattr(req, "source_addr_npi", 0),
-            destination_addr=getattr(req, "source_addr", b""),
-            esm_class=0x04,  # Delivery Receipt
-            protocol_id=0,
-            priority_flag=0,
-            schedule_delivery_time=b"",
-            validity_period=b"",
-            registered_delivery=0,
-            replace_if_present_flag=0,
-            data_coding=0,
-            sm_default_msg_id=0,
-            short_message=_dlr_text(message_id, stat=stat, sample=sample),
-            optional_parameters={
-                "receipted_message_id": rmid,
-                "message_state": 2,  # DELIVERED
-            },
+        return _pack_dlr(
+            seq_gen.next_sequence(),
+            req.dest_addr_ton, req.dest_addr_npi, req.destination_addr,
+            req.source_addr_ton, req.source_addr_npi, req.source_addr,
+            _dlr_text(message_id, stat=stat, sample=sample),
+            message_id or b"0",
         )
-        return dlr_pdu.generate()
     except Exception as e:
-        log.error(f"Не удалось собрать DLR deliver_sm: {e}", exc_info=True)
+        log.error("Не удалось собрать DLR deliver_sm: %s", e, exc_info=True)
         return b""
 # -------------- end DLR helpers --------------
 
 # ---------------- SMPP PDU read ----------------
-async def read_pdu_from_stream(reader: asyncio.StreamReader, seq_gen: SequenceGenerator) -> pdu.PDU:
-    len_bytes = await reader.readexactly(4)
-    length = struct.unpack(">L", len_bytes)[0]
-    if not (16 <= length <= 65536):
-        raise ValueError(f"Некорректная длина PDU: {length}")
-    body = await reader.readexactly(length - 4)
-    return smpp.parse_pdu(len_bytes + body, client=seq_gen, allow_unknown_opt_params=True)
-
-# ---------------- SMPP session handler ----------------
-async def smpp_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    peer = writer.get_extra_info("peername")
-    client_ip = peer[0] if peer else "?"
-    whitelist = build_effective_whitelist()
-
-    if not is_ip_allowed(client_ip, whitelist):
-        log.warning(f"[red]Отклонено соединение[/] с {client_ip}: IP не в whitelist")
-        try:
-            writer.close()
-            await writer.wait_closed()
-        except Exception:
-            pass
-        return
-
-    L = ConnAdapter(log, {"conn": client_ip})
-    seq = SequenceGenerator()
+def parse_pdu_frame(frame: bytes, seq_gen: SequenceGenerator) -> pdu.PDU:
+    return smpp.parse_pdu(frame, client=seq_gen, allow_unknown_opt_params=True)
+
+# Итог обработки SM для лога (по command_status)
+_VERDICT = {
+    ESME_ROK: "[green]OUR (0) OK[/]",
+    ESME_RSUBMITFAIL: "[yellow]ORPHAN (69) REJECT[/]",
+    ESME_RSYSERR: "[red]SYSERR (8)[/]",
+}
 
-    L.info("Новое подключение. Ожидаю BIND...")
-    bound = False
-    system_id_str = "?"
-    provider_id_hint: Optional[int] = None
-    provider_name_hint = "Unknown" # <<< ДОБАВЛЕНО
+# ---------------- DB worker pool ----------------
+# Блокирующая работа с БД (_handle_deliver_sm, поиск провайдера) уходит сюда,
+# чтобы медленный запрос не останавливал event loop и остальные SMPP-сессии.
+# Создаётся в main() по размеру пула соединений; None -> дефолтный executor loop'а.
+DB_POOL: Optional[ThreadPoolExecutor] = None
+
+# ---------------- SMPP session (BufferedProtocol) ----------------
+_PDU_MAX_LEN = 65536
+_FRAMES_HIGH_WATER = 64   # столько нераспарсенных PDU в очереди -> pause_reading
+_FRAMES_LOW_WATER = 16
+_READ_MIN_FREE = 16 * 1024  # свободного места в буфере меньше — сдвигаем недочитанный хвост в начало
+_OUT_FLUSH_BYTES = 4096  # столько накопленных ответов — сбрасываем, не дожидаясь конца входящей пачки
+_WRITE_HIGH_WATER = 64 * 1024  # выше — pause_writing(); пачка ответов (resp+DLR) укладывается с запасом
+
+class SmppProtocol(asyncio.BufferedProtocol):
+    """
+    Входящее SMPP-соединение. Транспорт пишет прямо в наш bytearray(64K) через
+    get_buffer/buffer_updated — без промежуточного StreamReader и лишнего bytes на чтение.
+    Готовые PDU нарезаются в очередь, логика сессии (BIND/ответы/DLR) — в задаче _session().
+    """
 
-    try:
-        while True:
+    def __init__(self) -> None:
+        self._buf = bytearray(_PDU_MAX_LEN)
+        self._view = memoryview(self._buf)
+        self._read_pos = 0
+        self._write_pos = 0
+        self._frames: deque = deque()
+        self._wake = asyncio.Event()
+        self._closed = False
+        self._reading_paused = False
+        self._writing_paused = False
+        self._drain_waiter: Optional[asyncio.Future] = None
+        self._out: List[bytes] = []  # ответы, накопленные за пачку входящих PDU
+        self._out_bytes = 0
+        self.transport: Optional[asyncio.Transport] = None
+        self.client_ip = "?"
+        self.client_addr = None  # ipaddress-объект, разобранный один раз в connection_made
+        self.seq = SequenceGenerator()
+        self.bound = False
+        self.system_id_str = "?"
+        self.provider_id_hint: Optional[int] = None
+        self.provider_name_hint = "Unknown"
+        self.db = None  # одна ORM-сессия на SMPP-соединение (коннект берётся из пула только на время транзакции)
+        self.L = ConnAdapter(log, {"conn": self.client_ip})
+        self._task: Optional[asyncio.Task] = None
+
+    # ----- transport callbacks -----
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        transport.set_write_buffer_limits(high=_WRITE_HIGH_WATER)
+        # пакетированием ответов управляем сами (_out/_flush), Nagle только добавил бы задержку
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
             try:
-                current_pdu = await read_pdu_from_stream(reader, seq)
-            except (ValueError, asyncio.IncompleteReadError) as e:
-                if isinstance(e, asyncio.IncompleteReadError):
-                    L.info("Клиент отключился.")
-                    break
-                L.info("[yellow]Получен некорректный пакет. Жду следующий...[/]")
-                continue
-
-            if not bound:
-                if current_pdu.command in ("bind_transceiver", "bind_transmitter", "bind_receiver"):
-                    try:
-                        system_id_str = current_pdu.system_id.decode("ascii", "ignore")
-                    except Exception:
-                        system_id_str = "?"
-                    L.info(f"Получен [cyan]BIND[/] от system_id='{system_id_str}' ([magenta]{current_pdu.command}[/])")
-                    writer.write(make_resp_bytes(current_pdu, ESME_ROK, system_id=b"SMSService"))
-                    await writer.drain()
-                    L.info("Авторизация успешна ([green]BOUND[/]). Слушаю входящие PDU...")
-                    bound = True
-                    with SessionLocal() as db_bind:
-                        provider_id_hint = resolve_provider_id_for_ip(db_bind, client_ip)
-                        if provider_id_hint:
-                            L.info(f"[cyan]RESOLVED[/] provider_id={provider_id_hint} по IP {client_ip}")
-                            # <<< НАЧАЛО ДОБАВЛЕННОГО БЛОКА
-                            prov_obj = db_bind.query(models.Provider.name).filter(models.Provider.id == provider_id_hint).first()
-                            if prov_obj:
-                                provider_name_hint = prov_obj.name
-                            # <<< КОНЕЦ ДОБАВЛЕННОГО БЛОКА
-                        else:
-                            L.warning(f"[yellow]RESOLVED[/]: не удалось определить provider_id по IP {client_ip}")
-                elif current_pdu.command == "enquire_link":
-                    L.warning(f"[yellow]Получен {current_pdu.command} до BIND[/] — отвечаю OK и жду bind_*")
-                    writer.write(make_resp_bytes(current_pdu, ESME_ROK))
-                    await writer.drain()
-                else:
-                    L.warning(f"[yellow]Команда {current_pdu.command} до BIND[/] — игнорирую")
-                continue
-
-            if current_pdu.command in ("enquire_link",):
-                writer.write(make_resp_bytes(current_pdu, ESME_ROK))
-                await writer.drain()
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (OSError, AttributeError):
+                pass
+        peer = transport.get_extra_info("peername")
+        # peername: (host, port) для IPv4, (host, port, flowinfo, scope_id) для IPv6
+        host, port = peer[:2] if isinstance(peer, tuple) else (str(peer or "?"), 0)
+        self.client_ip = host
+        try:
+            self.client_addr = ipaddress.ip_address(host)
+        except ValueError:
+            self.client_addr = None
+        self.L = ConnAdapter(log, {"conn": f"{host}:{port}"})
+        self._task = asyncio.get_running_loop().create_task(self._session())
+
+    def get_buffer(self, sizehint: int):
+        # весь буфер разобран — просто возвращаемся в начало, без копирования
+        if self._read_pos == self._write_pos:
+            self._read_pos = self._write_pos = 0
+        # недочитанный хвост сдвигаем, только когда места в конце мало: частичный PDU
+        # не копируется на каждое чтение; после сдвига PDU <= 64K всегда помещается
+        elif self._read_pos and len(self._buf) - self._write_pos < _READ_MIN_FREE:
+            tail = self._write_pos - self._read_pos
+            self._buf[:tail] = self._buf[self._read_pos:self._write_pos]
+            self._read_pos, self._write_pos = 0, tail
+        return self._view[self._write_pos:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._write_pos += nbytes
+        view = self._view
+        pos, end = self._read_pos, self._write_pos
+        while end - pos >= 4:
+            length = _PDU_LEN.unpack_from(self._buf, pos)[0]  # без среза memoryview на каждый PDU
+            if not (16 <= length <= _PDU_MAX_LEN):
+                # как раньше при readexactly(4): отбрасываем заголовок и ждём следующий
+                pos += 4
+                self._frames.append(None)
                 continue
-            if current_pdu.command in ("unbind",):
-                writer.write(make_resp_bytes(current_pdu, ESME_ROK))
-                await writer.drain()
-                L.info("Получен UNBIND — закрываю соединение")
+            if end - pos < length:
                 break
+            self._frames.append(view[pos:pos + length].tobytes())
+            pos += length
+        self._read_pos = pos
+        if self._frames:
+            self._wake.set()
+            if len(self._frames) >= _FRAMES_HIGH_WATER and not self._reading_paused:
+                self._reading_paused = True
+                self.transport.pause_reading()
+
+    def eof_received(self):
+        return None  # закрыть транспорт
+
+    def connection_lost(self, exc) -> None:
+        self._closed = True
+        self._wake.set()
+        w = self._drain_waiter
+        if w is not None and not w.done():
+            w.set_exception(ConnectionResetError("Соединение закрыто"))
+
+    def pause_writing(self) -> None:
+        self._writing_paused = True
+
+    def resume_writing(self) -> None:
+        self._writing_paused = False
+        w = self._drain_waiter
+        if w is not None and not w.done():
+            w.set_result(None)
+
+    # ----- helpers для сессии -----
+    async def _next_frame(self):
+        """Следующий кадр (bytes | None при битой длине); EOFError — соединение закрыто."""
+        while not self._frames:
+            if self._closed:
+                raise EOFError
+            self._wake.clear()
+            await self._wake.wait()
+        frame = self._frames.popleft()
+        if self._reading_paused and len(self._frames) <= _FRAMES_LOW_WATER and not self._closed:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return frame
+
+    def _queue(self, data: bytes) -> None:
+        self._out.append(data)
+        self._out_bytes += len(data)
+
+    async def _flush(self) -> None:
+        """Все накопленные ответы — одним writelines (scatter-gather), затем ожидание дренажа."""
+        if not self._out:
+            return
+        if self._closed:
+            self._out.clear()
+            self._out_bytes = 0
+            raise ConnectionResetError("Соединение закрыто")
+        self.transport.writelines(self._out)
+        self._out.clear()
+        self._out_bytes = 0
+        if self._writing_paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
+
+    async def _send(self, data: bytes) -> None:
+        """Немедленная отправка (bind_resp/unbind_resp): вместе с ранее накопленными ответами."""
+        self._queue(data)
+        await self._flush()
+
+    # ----- логика сессии -----
+    async def _session(self) -> None:
+        client_ip = self.client_ip
+        L = self.L
+
+        # Сначала статический whitelist из .env (bisect, без БД), затем полный (env + БД)
+        addr = self.client_addr
+        if addr is None or not (settings.is_smpp_ip_allowed(addr)
+                                or is_ip_allowed(addr, await _WL_CACHE.get())):
+            log.warning("[red]Отклонено соединение[/] с %s: IP не в whitelist", client_ip)
+            self.transport.close()
+            return
+
+        L.info("Новое подключение. Ожидаю BIND...")
+        try:
+            while True:
+                # входящая пачка разобрана (или ответов набралось много) — сбрасываем их разом
+                if self._out and (not self._frames or self._out_bytes >= _OUT_FLUSH_BYTES):
+                    try:
+                        await self._flush()
+                    except ConnectionResetError:
+                        L.info("Клиент отключился.")
+                        break
+                try:
+                    frame = await self._next_frame()
+                except EOFError:
+                    L.info("Клиент отключился.")
+                    break
+                # enquire_link после BIND (самый частый PDU на простаивающем bind) — ответ
+                # по заголовку кадра, без разбора в smpplib
+                if self.bound and frame is not None:
+                    _, cmd_id, _, seq = _PDU_HEADER.unpack_from(frame)
+                    if cmd_id == _ENQUIRE_LINK_ID:
+                        self._queue(_PDU_HEADER.pack(16, _ENQUIRE_LINK_RESP_ID, ESME_ROK, seq))
+                        continue
+                try:
+                    if frame is None:
+                        raise ValueError("Некорректная длина PDU")
+                    current_pdu = parse_pdu_frame(frame, self.seq)
+                except ValueError:
+                    L.info("[yellow]Получен некорректный пакет. Жду следующий...[/]")
+                    continue
+
+                if not self.bound:
+                    await self._handle_unbound(current_pdu)
+                    continue
+
+                handler = _BOUND_HANDLERS.get(current_pdu.command)
+                if handler is None:
+                    continue
+                if await handler(self, current_pdu):
+                    break
 
-            p = current_pdu
-            if p.command not in ("submit_sm", "deliver_sm"):
-                continue
+        except Exception as e:
+            log.exception("[red]Критическая ошибка соединения[/]: %s", e)
+        finally:
+            if self.db is not None:
+                try:
+                    self.db.close()
+                except Exception:
+                    pass
+            try:
+                self.transport.close()
+            except Exception:
+                pass
+            L.info("Сессия закрыта")
+
+    # ----- обработчики в состоянии BOUND (см. _BOUND_HANDLERS); True -> закрыть сессию -----
+    # enquire_link сюда не доходит: на него отвечает быстрый путь в _session()
+    async def _on_unbind(self, p: pdu.PDU) -> bool:
+        await self._send(make_resp_bytes(p, ESME_ROK))
+        self.L.info("Получен UNBIND — закрываю соединение")
+        return True
+
+    async def _on_message(self, p: pdu.PDU) -> bool:
+        await self._handle_sm(p)
+        return False
 
-            # лог для человека
+    async def _handle_unbound(self, current_pdu: pdu.PDU) -> None:
+        L = self.L
+        if current_pdu.command in _BIND_CMDS:
             try:
-                src = (p.source_addr or b"").decode("ascii", "ignore")
-                dst = (p.destination_addr or b"").decode("ascii", "ignore")
-                clean = get_decoded_text(p).replace("\r", " ").replace("\n", " ")
+                self.system_id_str = current_pdu.system_id.decode("ascii", "ignore")
             except Exception:
-                src, dst, clean = "?", "?", ""
+                self.system_id_str = "?"
+            L.info("Получен [cyan]BIND[/] от system_id='%s' ([magenta]%s[/])", self.system_id_str, current_pdu.command)
+            await self._send(make_resp_bytes(current_pdu, ESME_ROK, system_id=b"SMSService"))
+            L.info("Авторизация успешна ([green]BOUND[/]). Слушаю входящие PDU...")
+            self.bound = True
+            # сессия БД живёт от BIND до закрытия соединения; до BIND она не нужна
+            self.db = SessionLocal()
+            loop = asyncio.get_running_loop()
+            self.provider_id_hint, prov_name = await loop.run_in_executor(DB_POOL, self._resolve_provider_sync)
+            if self.provider_id_hint:
+                L.info("[cyan]RESOLVED[/] provider_id=%s по IP %s", self.provider_id_hint, self.client_ip)
+                if prov_name:
+                    self.provider_name_hint = prov_name
+            else:
+                L.warning("[yellow]RESOLVED[/]: не удалось определить provider_id по IP %s", self.client_ip)
+        elif current_pdu.command == "enquire_link":
+            L.warning("[yellow]Получен %s до BIND[/] — отвечаю OK и жду bind_*", current_pdu.command)
+            self._queue(make_resp_bytes(current_pdu, ESME_ROK))
+        else:
+            L.warning("[yellow]Команда %s до BIND[/] — игнорирую", current_pdu.command)
 
-            with SessionLocal() as db:
-                try:
-                    ctx = {"client_ip": client_ip, "system_id": system_id_str, "provider_id": provider_id_hint}
-                    res = _handle_deliver_sm(p, db, ctx)
-                    if isinstance(res, dict):
-                        status = int(res.get("status", ESME_RSYSERR))
-                        is_orphan = bool(res.get("is_orphan", False))
-                    else:
-                        status = int(res)
-                        is_orphan = (status == ESME_RSUBMITFAIL)
-                except Exception as e:
-                    L.error(f"[red]Ошибка обработки в воркере[/]: {e}")
-                    status, is_orphan = ESME_RSYSERR, False
-
-            # ЖЁСТКО: если это осиротевшее, всегда отдаём 69
-            if is_orphan:
-                status = ESME_RSUBMITFAIL
-
-            verdict = (
-                "[green]OUR (0) OK[/]" if status == ESME_ROK else
-                "[yellow]ORPHAN (69) REJECT[/]" if status == ESME_RSUBMITFAIL else
-                "[red]SYSERR (8)[/]" if status == ESME_RSYSERR else
-                f"[magenta]STATUS {status}[/]"
-            )
-            # <<< ЕДИНСТВЕННОЕ ИЗМЕНЕНИЕ ЛОГА >>>
+    # ----- синхронная работа с БД: выполняется в DB_POOL, не в event loop -----
+    def _resolve_provider_sync(self) -> Tuple[Optional[int], Optional[str]]:
+        # обычно чистый lookup в памяти; БД — только когда TTL индекса истёк
+        try:
+            idx = get_provider_index()
+            pid = idx.resolve(self.client_addr or self.client_ip)
+        except Exception as e:
+            log.warning("[yellow]RESOLVE PROVIDER[/]: ошибка чтения providers: %s", e)
+            return None, None
+        return pid, (idx.names.get(pid) if pid else None)
+
+    def _process_sm_sync(self, p: pdu.PDU, ctx: Dict[str, Any]):
+        db = self.db
+        try:
+            res = _handle_deliver_sm(p, db, ctx)
+            db.commit()
+            return res
+        except Exception:
+            try: db.rollback()
+            except Exception: pass
+            raise
+        finally:
+            # сессия живёт всё соединение: не держим объекты прошлых PDU (устаревшие статусы сессий)
+            db.expunge_all()
+
+    async def _handle_sm(self, p: pdu.PDU) -> None:
+        L = self.L
+        client_ip = self.client_ip
+        provider_id_hint = self.provider_id_hint
+
+        # src/dst/текст для лога берём из результата воркера: PDU декодируется один раз
+        src, dst, text = "?", "?", ""
+        try:
+            ctx = {"client_ip": client_ip, "system_id": self.system_id_str, "provider_id": provider_id_hint}
+            res = await asyncio.get_running_loop().run_in_executor(DB_POOL, self._process_sm_sync, p, ctx)
+            if isinstance(res, dict):
+                status = int(res.get("status", ESME_RSYSERR))
+                is_orphan = bool(res.get("is_orphan", False))
+                src = res.get("src", src)
+                dst = res.get("dst", dst)
+                text = res.get("text") or ""
+            else:
+                status = int(res)
+                is_orphan = (status == ESME_RSUBMITFAIL)
+        except Exception as e:
+            L.error("[red]Ошибка обработки в воркере[/]: %s", e)
+            status, is_orphan = ESME_RSYSERR, False
+
+        # ЖЁСТКО: если это осиротевшее, всегда отдаём 69
+        if is_orphan:
+            status = ESME_RSUBMITFAIL
+
+        if L.isEnabledFor(logging.INFO):
+            verdict = _VERDICT.get(status) or f"[magenta]STATUS {status}[/]"
             L.info(
-                f"{verdict}: {p.command} src='{src}' dst='{dst}' | "
-                f"provider={provider_name_hint}({provider_id_hint if provider_id_hint is not None else 'NULL'}) "
-                f"ip={client_ip} sid={system_id_str} text='{clean[:200]}'"
+                "%s: %s src='%s' dst='%s' | provider=%s(%s) ip=%s sid=%s text='%s'",
+                verdict, p.command, src, dst,
+                self.provider_name_hint, provider_id_hint if provider_id_hint is not None else "NULL",
+                client_ip, self.system_id_str, text[:200].translate(_ONE_LINE),
             )
 
-            # Ответ (вручную, с правильным sequence)
-            body_msg_id = None
-            if p.command == "submit_sm" and status == ESME_ROK:
-                body_msg_id = str(random.randint(10000, 99999)).encode("ascii")
-            resp_bytes = make_resp_bytes(p, status, message_id=body_msg_id)
-            try:
-                writer.write(resp_bytes)
-                await writer.drain()
-            except Exception as e:
-                L.error(f"ОШИБКА ПРИ ОТПРАВКЕ ОТВЕТА: {e}", exc_info=True)
+        # Ответ (вручную, с правильным sequence)
+        body_msg_id = None
+        if p.command == "submit_sm" and status == ESME_ROK:
+            body_msg_id = _next_message_id()
+        self._queue(make_resp_bytes(p, status, message_id=body_msg_id))
 
-            # НОВОЕ: если submit_sm принят (OK) — сразу шлём DLR (deliver_sm с esm_class=0x04 + TLV)
-            try:
-                if p.command == "submit_sm" and status == ESME_ROK:
-                    dlr_bytes = make_dlr_deliver_sm_bytes(
-                        req=p,
-                        seq_gen=seq,
-                        message_id=body_msg_id or b"0",
-                        stat="DELIVRD",
-                        sample=clean,
-                    )
-                    if dlr_bytes:
-                        writer.write(dlr_bytes)
-                        await writer.drain()
-                        L.info("[green]DLR отправлен[/]: stat=DELIVRD id=%s",
+        # если submit_sm принят (OK) — сразу шлём DLR (deliver_sm с esm_class=0x04 + TLV)
+        try:
+            if p.command == "submit_sm" and status == ESME_ROK:
+                dlr_bytes = make_dlr_deliver_sm_bytes(
+                    req=p,
+                    seq_gen=self.seq,
+                    message_id=body_msg_id or b"0",
+                    stat="DELIVRD",
+                    sample=text,  # _dlr_text сам берёт первые 20 символов и убирает CR/LF
+                )
+                if dlr_bytes:
+                    self._queue(dlr_bytes)
+                    if L.isEnabledFor(logging.INFO):
+                        L.info("[green]DLR поставлен в отправку[/]: stat=DELIVRD id=%s",
                                (body_msg_id or b'0').decode('ascii', 'ignore'))
-            except Exception as e:
-                L.error(f"ОШИБКА ПРИ ОТПРАВКЕ DLR: {e}", exc_info=True)
+        except Exception as e:
+            L.error("ОШИБКА ПРИ ОТПРАВКЕ DLR: %s", e, exc_info=True)
 
-    except Exception as e:
-        log.exception(f"[red]Критическая ошибка соединения[/]: {e}")
-    finally:
-        try:
-            writer.close()
-            await writer.wait_closed()
-        except Exception:
-            pass
-        L.info("Сессия закрыта")
+# Диспетчер команд после BIND: один поиск в dict вместо цепочки сравнений строк
+_BOUND_HANDLERS = {
+    "unbind": SmppProtocol._on_unbind,
+    "submit_sm": SmppProtocol._on_message,
+    "deliver_sm": SmppProtocol._on_message,
+}
 
 # ---------------- Outbound (мы к ним) ----------------
 def _is_outbound(p: models.Provider) -> bool:
@@ -456,7 +887,6 @@ def _is_outbound(p: models.Provider) -> bool:
     return t in ("outbound", "out", "client", "мы к ним")
 
 def start_outbound_from_db():
-    import threading
     stop_evt = threading.Event()
     threads = []
     with SessionLocal() as db:
@@ -466,7 +896,7 @@ def start_outbound_from_db():
             t = threading.Thread(target=run_smpp_provider_loop, args=(p, stop_evt), daemon=True)
             t.start()
             threads.append((p.name, t))
-            log.info(f"[OUTBOUND] started thread for provider {p.name}")
+            log.info("[OUTBOUND] started thread for provider %s", p.name)
     return stop_evt, threads
 
 def stop_outbound(stop_evt, threads):
@@ -475,16 +905,17 @@ def stop_outbound(stop_evt, threads):
         for name, t in threads:
             t.join(timeout=2.0)
             if t.is_alive():
-                log.warning(f"[OUTBOUND] thread did not stop timely: {name}")
+                log.warning("[OUTBOUND] thread did not stop timely: %s", name)
             else:
-                log.info(f"[OUTBOUND] thread stopped: {name}")
+                log.info("[OUTBOUND] thread stopped: %s", name)
     except Exception:
         pass
 
 # ---------------- Entrypoint ----------------
 async def main():
+    global DB_POOL
     host = settings.SMPP_BIND_HOST or "0.0.0.0"
-    ports = settings.get_smpp_bind_ports()
+    ports = settings.smpp_bind_ports
 
     servers: List[asyncio.AbstractServer] = []
     try:
@@ -495,17 +926,19 @@ async def main():
 
     outbound_stop_evt = None
     outbound_threads = []
+    loop = asyncio.get_running_loop()
+    DB_POOL = ThreadPoolExecutor(max_workers=max(1, engine.pool.size()), thread_name_prefix="smpp-db")
     try:
         for port in ports:
-            srv = await asyncio.start_server(smpp_session, host, port)
+            srv = await loop.create_server(SmppProtocol, host, port)
             servers.append(srv)
             addr = ", ".join(str(s.getsockname()) for s in srv.sockets)
-            log.info(f"[bold]SMPP inbound слушает[/]: {addr}")
+            log.info("[bold]SMPP inbound слушает[/]: %s", addr)
 
         try:
             outbound_stop_evt, outbound_threads = start_outbound_from_db()
         except Exception as e:
-            log.warning(f"[yellow]OUTBOUND[/]: не удалось запустить: {e}")
+            log.warning("[yellow]OUTBOUND[/]: не удалось запустить: %s", e)
 
         await asyncio.gather(*[s.serve_forever() for s in servers])
 
@@ -515,12 +948,19 @@ async def main():
         for srv in servers:
             srv.close()
             await srv.wait_closed()
+        DB_POOL.shutdown(wait=True)
         stop_concatenation_worker()
         if outbound_stop_evt is not None:
             stop_outbound(outbound_stop_evt, outbound_threads)
         log.info("[bold]Сервер полностью остановлен[/]")
 
 if __name__ == "__main__":
+    # uvloop (если установлен): C-реализация event loop и транспортов
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -2,11 +2,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import functools
 import logging
+import queue
+import struct
 import time
 import threading
 import re
-from typing import Optional, Any, Dict, Tuple, Callable
+from collections import OrderedDict
+from typing import Optional, Any, Dict, List, Tuple, Callable
 
 # --- optional Redis (используем, если доступен) ---
 try:
@@ -19,7 +23,16 @@ except Exception:
 import smpplib.client  # type: ignore
 import smpplib.exceptions  # type: ignore
 
-from sqlalchemy.orm import Session as SASession, selectinload
+# GSM-декодер smpplib (в части версий его нет) — ищем один раз при импорте, а не на каждое SMS
+try:
+    import smpplib.gsm  # type: ignore
+    _gsm_decode = getattr(smpplib.gsm, "decode", None)
+except Exception:
+    _gsm_decode = None
+
+import sqlalchemy as sa
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session as SASession, joinedload
 from sqlalchemy.exc import SQLAlchemyError
 
 from src.database import SessionLocal
@@ -51,88 +64,136 @@ if _redis_import_ok:
 # ===============================
 # Concat buffer (in-memory)
 # ===============================
-_concat_buf: Dict[Tuple[str, str, int], Dict[str, Any]] = {}
-_concat_lock = threading.Lock()
+# Буфер разбит на шарды по hash(key): у каждого свой лок, части разных SMS из параллельных
+# SMPP-потоков не ждут друг друга. Внутри шарда OrderedDict в порядке последнего обновления:
+# голова — самый «старый» ключ. TTL у всех одинаковый, поэтому просроченные всегда лежат подряд
+# в голове и снимаются лениво при каждой новой части за O(просроченных) — без GC-потока
 _CONCAT_TTL_SEC = 300  # 5 минут
-
-# GC поток для буфера конкатенации
-_gc_stop = threading.Event()
-_gc_thread: Optional[threading.Thread] = None
-
+_CONCAT_MAX_KEYS = 100_000  # жёсткий предел на весь буфер: при переполнении шарда вытесняем его самый старый ключ
+_CONCAT_SHARDS = 32  # степень двойки: номер шарда = hash(key) & (_CONCAT_SHARDS - 1)
+_CONCAT_SHARD_MAX_KEYS = _CONCAT_MAX_KEYS // _CONCAT_SHARDS
+_concat_shards: "List[Tuple[threading.Lock, OrderedDict[Tuple[str, str, int], Dict[str, Any]]]]" = [
+    (threading.Lock(), OrderedDict()) for _ in range(_CONCAT_SHARDS)
+]
+
+# Пакетная запись сирот (OrphanSms, включая [PART]-строки): строки копятся в очереди и пишутся
+# одним multi-row INSERT на пачку, а не commit на каждое SMS в потоке SMPP-коллбэка
+_orphan_queue: "queue.Queue[Optional[Tuple[str, str, str, Optional[Dict[str, Any]]]]]" = queue.Queue(maxsize=10_000)
+_orphan_thread: Optional[threading.Thread] = None
+_ORPHAN_BATCH_MAX = 500        # максимум строк в одной транзакции
+_ORPHAN_BATCH_DEEP = 20        # при такой глубине очереди ждём добора, а не пишем сразу
+_ORPHAN_BATCH_WAIT_SEC = 0.005
 
 # ===============================
 # Decoding helpers
 # ===============================
+# Управляющие символы (включая NUL и DEL), кроме \n \r \t — удаляются одним translate
+_CTRL_DELETE = dict.fromkeys(c for c in range(32) if chr(c) not in "\n\r\t")
+_CTRL_DELETE[0x7F] = None
+
 def _sanitize_text(s: str) -> str:
     if not s:
         return ""
-    s = s.replace("\x00", "")
-    return "".join(ch for ch in s if (ch >= " " or ch in "\n\r\t"))
+    # isprintable() — один проход в C без аллокаций; обычное однострочное SMS отдаём как есть
+    if s.isprintable():
+        return s
+    return s.translate(_CTRL_DELETE)
 
 
 def _decode_bytes(msg: bytes | memoryview | None, data_coding: int) -> str:
     if not msg:
         return ""
-    if isinstance(msg, memoryview):
-        msg = msg.tobytes()
 
+    # str(buf, encoding, errors) принимает и bytes, и memoryview — декодируем без промежуточной копии
     try:
+        if data_coding == 0:  # GSM 7-bit / ASCII fallback — самый частый случай
+            if _gsm_decode is not None:
+                try:
+                    return _sanitize_text(_gsm_decode(msg if isinstance(msg, bytes) else bytes(msg)))
+                except Exception:
+                    pass
+            return _sanitize_text(str(msg, "ascii", "ignore"))
         if data_coding == 8:  # UCS2 (UTF-16BE)
-            return _sanitize_text(bytes(msg).decode("utf-16be", errors="ignore"))
-        if data_coding == 0:  # GSM 7-bit / ASCII fallback
-            try:
-                import smpplib.gsm  # type: ignore
-                return _sanitize_text(smpplib.gsm.decode(bytes(msg)))
-            except Exception:
-                return _sanitize_text(bytes(msg).decode("ascii", errors="ignore"))
-        return _sanitize_text(bytes(msg).decode("latin1", errors="ignore"))
+            return _sanitize_text(str(msg, "utf-16be", "ignore"))
+        return _sanitize_text(str(msg, "latin1", "ignore"))
     except Exception:
-        return _sanitize_text(bytes(msg).decode("latin1", errors="ignore"))
+        return _sanitize_text(str(msg, "latin1", "ignore"))
+
+
+_UDH_CONCAT8 = struct.Struct(">BBB")    # IEI 0x00: ref(1), total, seq
+_UDH_CONCAT16 = struct.Struct(">HBB")   # IEI 0x08: ref(2), total, seq
 
 
-def _parse_udh(sm: bytes) -> Tuple[bytes, Optional[Tuple[int, int, int]]]:
+def _parse_udh(sm: bytes) -> Tuple[bytes | memoryview, Optional[Tuple[int, int, int]]]:
+    """
+    UDH разбираем по смещениям в исходном буфере (unpack_from), без срезов на каждый IE.
+    Тело после UDH отдаём memoryview поверх sm: декод и склейка частей читают его без копии.
+    """
     if not sm:
         return sm, None
     try:
+        n = len(sm)
         udhl = sm[0]
-        if udhl == 0 or (1 + udhl) > len(sm):
+        end = 1 + udhl
+        if udhl == 0 or end > n:
             return sm, None
-        udh = sm[1:1+udhl]
-        i = 0
-        ref = total = seq = None
-        while i < len(udh):
-            iei = udh[i]; i += 1
-            if i >= len(udh): break
-            ielen = udh[i]; i += 1
-            if i + ielen > len(udh): break
-            iedata = udh[i:i+ielen]; i += ielen
+        i = 1
+        concat = None
+        while i + 1 < end:
+            iei = sm[i]
+            ielen = sm[i + 1]
+            i += 2
+            if i + ielen > end:
+                break
             if iei == 0x00 and ielen == 3:
-                ref = iedata[0]; total = iedata[1]; seq = iedata[2]
+                concat = _UDH_CONCAT8.unpack_from(sm, i)
             elif iei == 0x08 and ielen == 4:
-                ref = (iedata[0] << 8) | iedata[1]; total = iedata[2]; seq = iedata[3]
-        if ref is not None and total and seq:
-            return sm[1+udhl:], (int(ref), int(total), int(seq))
+                concat = _UDH_CONCAT16.unpack_from(sm, i)
+            i += ielen
+        if concat is not None and concat[1] and concat[2]:
+            return memoryview(sm)[end:], concat
         return sm, None
     except Exception:
         return sm, None
 
 
-def _store_concat_piece(src: str, dst: str, ref: int, total: int, seq: int, piece_text: str) -> Optional[str]:
+def _store_concat_piece(src: str, dst: str, ref: int, total: int, seq: int, piece: bytes | memoryview) -> Optional[bytes]:
+    """
+    Копит сырые байты частей; на последней части возвращает склеенное тело (bytes).
+    Декодируем один раз целиком — UCS2-суррогаты и GSM-escape на стыке частей не рвутся.
+    Части лежат в списке по позиции seq-1: при сборке не нужна сортировка, только join.
+    """
+    total, seq = int(total), int(seq)
+    if not 1 <= seq <= total:
+        return None  # битый номер части — собрать по нему всё равно нечего
     key = (src or "", dst or "", int(ref))
     now = time.time()
-    with _concat_lock:
-        bucket = _concat_buf.get(key)
+    lock, buf = _concat_shards[hash(key) & (_CONCAT_SHARDS - 1)]
+    with lock:
+        # сначала снимаем просроченные: истёкший ключ не должен «ожить» от опоздавшей части
+        while buf and now - next(iter(buf.values()))["ts"] > _CONCAT_TTL_SEC:
+            buf.popitem(last=False)
+        bucket = buf.get(key)
         if not bucket:
-            bucket = {"total": int(total), "parts": {}, "ts": now}
-            _concat_buf[key] = bucket
+            bucket = {"total": total, "parts": [None] * total, "filled": 0, "ts": now}
+            buf[key] = bucket
+            if len(buf) > _CONCAT_SHARD_MAX_KEYS:
+                buf.popitem(last=False)
+        else:
+            buf.move_to_end(key)
         bucket["ts"] = now
-        bucket["total"] = max(int(total), int(bucket["total"] or total))
-        bucket["parts"][int(seq)] = piece_text
-
-        if bucket["total"] and len(bucket["parts"]) >= bucket["total"]:
-            full = "".join(bucket["parts"][i] for i in sorted(bucket["parts"]))
-            _concat_buf.pop(key, None)
-            return full
+        parts = bucket["parts"]
+        if total > bucket["total"]:
+            # части одного SMS разошлись в total — берём больший, как и раньше
+            parts.extend([None] * (total - bucket["total"]))
+            bucket["total"] = total
+        if parts[seq - 1] is None:
+            bucket["filled"] += 1
+        parts[seq - 1] = piece
+
+        if bucket["filled"] == bucket["total"]:
+            buf.pop(key, None)
+            return b"".join(parts)
     return None
 
 
@@ -156,78 +217,136 @@ def _maybe_reassemble_concat(pdu, src: str, dst: str) -> Tuple[str, bool]:
         payload, concat = _parse_udh(sm)
         if concat:
             ref, total, seq = concat
-            piece = _decode_bytes(payload, data_coding)
-            full = _store_concat_piece(src, dst, ref, total, seq, piece)
+            full = _store_concat_piece(src, dst, ref, total, seq, payload)
             if full is not None:
-                return full, True
-            return piece, False
+                return _decode_bytes(full, data_coding), True
+            return _decode_bytes(payload, data_coding), False
         return _decode_bytes(payload, data_coding), True
     try:
         ref = getattr(pdu, "sar_msg_ref_num", None)
         total = getattr(pdu, "sar_total_segments", None)
         seq = getattr(pdu, "sar_segment_seqnum", None)
         if ref and total and seq:
-            piece = _decode_bytes(sm, data_coding)
-            full = _store_concat_piece(src, dst, int(ref), int(total), int(seq), piece)
+            full = _store_concat_piece(src, dst, int(ref), int(total), int(seq), sm)
             if full is not None:
-                return full, True
-            return piece, False
+                return _decode_bytes(full, data_coding), True
+            return _decode_bytes(sm, data_coding), False
     except Exception:
         pass
     return _decode_bytes(sm, data_coding), True
 
 
+def _addr_str(v: Any) -> str:
+    """C-Octet адрес -> str: NUL срезаем до decode (latin1 не падает на любых байтах)."""
+    if not v:
+        return ""
+    if isinstance(v, memoryview):
+        v = v.tobytes()
+    if isinstance(v, (bytes, bytearray)):
+        return v.rstrip(b"\x00").decode("latin1").strip()
+    return str(v).strip()
+
 def _extract_src_dst(pdu) -> Tuple[str, str]:
     try:
-        s = getattr(pdu, "source_addr", b"") or b""
-        src = s.decode("latin1", "ignore") if isinstance(s, (bytes, bytearray, memoryview)) else str(s)
+        src = _addr_str(getattr(pdu, "source_addr", b""))
     except Exception:
         src = ""
     try:
-        d = getattr(pdu, "destination_addr", b"") or b""
-        dst = d.decode("latin1", "ignore") if isinstance(d, (bytes, bytearray, memoryview)) else str(d)
+        dst = _addr_str(getattr(pdu, "destination_addr", b""))
     except Exception:
         dst = ""
-    return (src or "").strip(), (dst or "").strip()
+    return src, dst
 
 
-_COUNTRY_CACHE: Optional[Dict[str, int]] = None
+# Телефонные коды стран, сгруппированные по длине: [(длина, {код: country_id}), ...] от длинных
+# к коротким. Проверяем только длины, которые реально есть в справочнике (коды длиннее 4 не берём)
+_COUNTRY_CACHE: Optional[List[Tuple[int, Dict[str, int]]]] = None
+_country_cache_lock = threading.Lock()
 
-def _load_country_cache(db: SASession) -> Dict[str, int]:
+def _load_country_cache(db: SASession, force: bool = False) -> List[Tuple[int, Dict[str, int]]]:
     global _COUNTRY_CACHE
-    if _COUNTRY_CACHE is not None:
-        return _COUNTRY_CACHE
-    mapping: Dict[str, int] = {}
-    try:
-        rows = db.query(models.Country.id, models.Country.phone_code).all()
+    cache = _COUNTRY_CACHE
+    if cache is not None and not force:
+        return cache
+    with _country_cache_lock:
+        # пока ждали лок, справочник мог загрузить соседний поток
+        if _COUNTRY_CACHE is not None and not force:
+            return _COUNTRY_CACHE
+        by_len: Dict[int, Dict[str, int]] = {}
+        try:
+            rows = db.query(models.Country.id, models.Country.phone_code).all()
+        except Exception as e:
+            # не кэшируем пустой справочник: следующий вызов попробует ещё раз
+            log.warning("Не удалось загрузить справочник стран: %s", e)
+            return _COUNTRY_CACHE or []
         for cid, pcode in rows:
             if not pcode: continue
             code = str(pcode).strip().lstrip("+")
-            if code.isdigit(): mapping[code] = cid
-    except Exception as e:
-        log.warning("Не удалось загрузить справочник стран: %s", e)
-    _COUNTRY_CACHE = mapping
-    return mapping
+            if code.isdigit() and len(code) <= 4:
+                by_len.setdefault(len(code), {})[code] = cid
+        _COUNTRY_CACHE = sorted(by_len.items(), reverse=True)
+        _country_id_for_number.cache_clear()  # результаты зависят от справочника
+        return _COUNTRY_CACHE
+
+def warm_country_cache(db: Optional[SASession] = None) -> None:
+    """
+    (Пере)читать справочник кодов стран заранее — при старте и после правки стран,
+    чтобы первые SMS не ждали загрузку. Без db открывает и закрывает свою сессию.
+    """
+    if db is not None:
+        _load_country_cache(db, force=True)
+        return
+    own = SessionLocal()
+    try:
+        _load_country_cache(own, force=True)
+    finally:
+        own.close()
+
+_NON_DIGITS_RE = re.compile(r"\D+")
 
 def _resolve_country_id_by_msisdn(db: SASession, number_str: str) -> Optional[int]:
     if not number_str: return None
-    digits = "".join(ch for ch in number_str if ch.isdigit())
+    _load_country_cache(db)
+    return _country_id_for_number(number_str)
+
+@functools.lru_cache(maxsize=8192)
+def _country_id_for_number(number_str: str) -> Optional[int]:
+    """Номера повторяются (части длинных SMS, повторные SMS) — разбор префикса один раз на номер."""
+    digits = _NON_DIGITS_RE.sub("", number_str)
     if not digits: return None
-    m = _load_country_cache(db)
-    for ln in (4, 3, 2, 1):
+    for ln, codes in _COUNTRY_CACHE or ():
         if len(digits) >= ln:
-            prefix = digits[:ln]
-            if prefix in m: return m[prefix]
+            cid = codes.get(digits[:ln])
+            if cid is not None: return cid
     return None
 
 
-def _find_active_session(db: SASession, dst_raw: str) -> Optional[models.Session]:
+# Номера назначения у провайдера повторяются, а результат разбора phonenumbers для номера
+# не меняется — парсим каждый номер один раз. Кандидаты — кортеж: кэш отдаёт общий объект.
+_normalize_dst = functools.lru_cache(maxsize=65536)(normalize_phone_number)
+
+@functools.lru_cache(maxsize=65536)
+def _phone_candidates(dst_raw: str) -> Tuple[str, ...]:
+    return tuple(build_phone_candidates(dst_raw))
+
+def _find_active_session(db: SASession, dst_raw: str, cands: Optional[Tuple[str, ...]] = None) -> Optional[models.Session]:
+    """
+    Последняя активная сессия номера (не больше одной строки, LIMIT 1).
+    Отправителя здесь сознательно не фильтруем: SMS от чужого отправителя на номер с активной
+    сессией должно стать сиротой (SENDER MISMATCH), а не уйти в более старую подходящую сессию.
+    """
     if not dst_raw: return None
-    cands = build_phone_candidates(dst_raw) or [dst_raw]
+    cands = cands or _phone_candidates(dst_raw) or (dst_raw,)
     try:
         return (
             db.query(models.Session)
-              .options(selectinload(models.Session.service))
+              # many-to-one: один JOIN вместо второго SELECT. Воркеру от сервиса нужны только name и
+              # allowed_senders; service_limits (lazy="selectin") не грузим — это был бы лишний запрос на SMS
+              .options(
+                  joinedload(models.Session.service)
+                  .load_only(models.Service.name, models.Service.allowed_senders)
+                  .lazyload(models.Service.service_limits)
+              )
               .filter(models.Session.phone_number_str.in_(cands))
               .filter(models.Session.status.in_([1, 3]))
               .order_by(models.Session.id.desc())
@@ -244,13 +363,20 @@ def _extract_code(text: str) -> Optional[str]:
     m = _code_re.search(text or "")
     return m.group(1) if m else None
 
+_STORE_SMS_SQL = sa.text("""
+    WITH ins AS (
+        INSERT INTO sms_messages (session_id, source_addr, text, code)
+        VALUES (:sid, :src, :text, :code)
+    )
+    UPDATE sessions SET status = 2 WHERE id = :sid
+""")
+
 def _store_sms_for_session(db: SASession, sess: models.Session, src: str, text: str) -> bool:
     try:
-        msg = models.SmsMessage(session_id=sess.id, source_addr=(src or "")[:255], text=text or "", code=_extract_code(text))
-        db.add(msg)
-        try:
-            sess.status = 2
-        except Exception: pass
+        # INSERT + UPDATE одним запросом (data-modifying CTE): один roundtrip и commit, без unit-of-work ORM
+        db.execute(_STORE_SMS_SQL, {
+            "sid": sess.id, "src": (src or "")[:255], "text": text or "", "code": _extract_code(text),
+        })
         db.commit()
         return True
     except Exception as e:
@@ -259,24 +385,51 @@ def _store_sms_for_session(db: SASession, sess: models.Session, src: str, text:
         except Exception: pass
         return False
 
+# номер -> (expires_at, (provider_id, country_id, operator_id) | None): спам-волны на один номер
+# не дёргают phone_numbers на каждую сироту; промахи кэшируются тоже
+_PHONE_META_CACHE: Dict[str, Tuple[float, Optional[Tuple[Any, Any, Any]]]] = {}
+_PHONE_META_TTL_SEC = 60
+_PHONE_META_MAX = 8192
+_phone_meta_lock = threading.Lock()
+
+def _phone_meta(db: SASession, norm_dst: str) -> Optional[Tuple[Any, Any, Any]]:
+    now = time.monotonic()
+    hit = _PHONE_META_CACHE.get(norm_dst)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    # Core select -> лёгкий Row: без ORM-объекта, identity map и Query-обёртки
+    row = db.execute(
+        select(models.PhoneNumber.provider_id, models.PhoneNumber.country_id, models.PhoneNumber.operator_id)
+        .where(models.PhoneNumber.number_str == norm_dst)
+        .limit(1)
+    ).first()
+    meta = tuple(row) if row else None
+    with _phone_meta_lock:
+        if len(_PHONE_META_CACHE) >= _PHONE_META_MAX:
+            _PHONE_META_CACHE.clear()
+        _PHONE_META_CACHE[norm_dst] = (now + _PHONE_META_TTL_SEC, meta)
+    return meta
+
+def _orphan_row(db: SASession, dst: str, src: str, text: str, ctx: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    norm_dst = (_normalize_dst(dst) if dst else "") or dst or ""
+    prov_id = (ctx or {}).get("provider_id")
+    country_id, operator_id = None, None
+    meta = _phone_meta(db, norm_dst)
+    if meta:
+        prov_id = prov_id or meta[0]
+        country_id, operator_id = meta[1], meta[2]
+    if not country_id:
+        cid = _resolve_country_id_by_msisdn(db, norm_dst)
+        if cid: country_id = cid
+    return dict(
+        phone_number_str=norm_dst, source_addr=(src or "")[:255], text=text or "",
+        provider_id=prov_id, country_id=country_id, operator_id=operator_id,
+        client_ip=(ctx or {}).get("client_ip"), system_id=(ctx or {}).get("system_id"),
+    )
+
 def _store_orphan(db: SASession, dst: str, src: str, text: str, ctx: Optional[Dict[str, Any]]) -> bool:
     try:
-        norm_dst = normalize_phone_number(dst) or dst or ""
-        prov_id = (ctx or {}).get("provider_id")
-        country_id, operator_id = None, None
-        pn = db.query(models.PhoneNumber).filter(models.PhoneNumber.number_str == norm_dst).first()
-        if pn:
-            prov_id = prov_id or pn.provider_id
-            country_id, operator_id = pn.country_id, pn.operator_id
-        if not country_id:
-            cid = _resolve_country_id_by_msisdn(db, norm_dst)
-            if cid: country_id = cid
-        rec = models.OrphanSms(
-            phone_number_str=norm_dst, source_addr=(src or "")[:255], text=text or "",
-            provider_id=prov_id, country_id=country_id, operator_id=operator_id,
-            client_ip=(ctx or {}).get("client_ip"), system_id=(ctx or {}).get("system_id"),
-        )
-        db.add(rec)
+        db.add(models.OrphanSms(**_orphan_row(db, dst, src, text, ctx)))
         db.commit()
         return True
     except Exception as e:
@@ -285,6 +438,76 @@ def _store_orphan(db: SASession, dst: str, src: str, text: str, ctx: Optional[Di
         except Exception: pass
         return False
 
+def _enqueue_orphan(db: SASession, dst: str, src: str, text: str, ctx: Optional[Dict[str, Any]]) -> bool:
+    """Сирота в пакетную очередь; без запущенного писателя или при переполненной очереди — сразу в БД."""
+    if _orphan_thread is None or not _orphan_thread.is_alive():
+        return _store_orphan(db, dst, src, text, ctx)
+    try:
+        _orphan_queue.put_nowait((dst, src, text, dict(ctx) if ctx else None))
+    except queue.Full:
+        return _store_orphan(db, dst, src, text, ctx)
+    return True
+
+def _flush_orphan_batch(db: SASession, batch: list) -> None:
+    try:
+        rows = [_orphan_row(db, *item) for item in batch]
+        # Core insert (executemany -> multi-row VALUES), без unit-of-work ORM на каждую строку
+        db.execute(insert(models.OrphanSms), rows)
+        db.commit()
+    except Exception as e:
+        log.error("DB: пакет сирот (%d шт.) не записан, пишу по одной: %s", len(batch), e)
+        try: db.rollback()
+        except Exception: pass
+        for item in batch:
+            _store_orphan(db, *item)
+    finally:
+        db.expunge_all()
+
+def _orphan_writer_loop() -> None:
+    """
+    Адаптивный батчинг: мелкая очередь — пишем сразу (минимальная задержка),
+    глубокая — ждём до _ORPHAN_BATCH_WAIT_SEC, чтобы набрать пачку побольше.
+    None в очереди — сигнал остановки (после записи уже накопленного).
+    Одна ORM-сессия на весь поток писателя: коннект берётся из пула только на время транзакции.
+    """
+    db = SessionLocal()
+    try:
+        _orphan_writer_run(db)
+    finally:
+        db.close()
+
+def _orphan_writer_run(db: SASession) -> None:
+    stop = False
+    while not stop:
+        item = _orphan_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = None
+        while len(batch) < _ORPHAN_BATCH_MAX:
+            try:
+                nxt = _orphan_queue.get_nowait()
+            except queue.Empty:
+                if len(batch) < _ORPHAN_BATCH_DEEP:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + _ORPHAN_BATCH_WAIT_SEC
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = _orphan_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if nxt is None:
+                stop = True
+                break
+            batch.append(nxt)
+        try:
+            _flush_orphan_batch(db, batch)
+        except Exception:
+            log.exception("[ORPHAN] writer: ошибка записи пачки")
+
 def get_decoded_text(pdu) -> str:
     src, dst = _extract_src_dst(pdu)
     text, _ = _maybe_reassemble_concat(pdu, src, dst)
@@ -293,6 +516,30 @@ def get_decoded_text(pdu) -> str:
 # =================================================================
 # >>> НАЧАЛО ОБНОВЛЕННОЙ И УЛУЧШЕННОЙ ЛОГИКИ <<<
 # =================================================================
+@functools.lru_cache(maxsize=4096)
+def _normalize_sender(sender: str) -> str:
+    """
+    Имя отправителя без пробелов, в нижнем регистре ("Google OTP" -> "googleotp").
+    Отправителей немного и они повторяются — нормализуем каждого один раз.
+    """
+    return "".join(sender.lower().split())
+
+@functools.lru_cache(maxsize=4096)
+def _allowed_senders_set(allowed_senders_raw: str, service_name: str) -> Optional[frozenset]:
+    """
+    Нормализованный набор разрешённых отправителей сервиса (None — "*", разрешено всё).
+    Кэшируется по сырым значениям полей: строка из БД разбирается один раз, а не на каждое SMS;
+    правка allowed_senders/name в админке даёт новый ключ.
+    """
+    # Если в поле стоит одна звездочка, сервис "всеядный" - разрешаем всё.
+    if allowed_senders_raw.strip() == '*':
+        return None
+    # Пример: "GoogleOTP, Google OTP" -> {"googleotp"}
+    allowed = {"".join(s.lower().split()) for s in allowed_senders_raw.split(',') if s.strip()}
+    # Fallback: основное имя сервиса (тоже нормализованное) разрешено всегда
+    allowed.add("".join(service_name.lower().split()))
+    return frozenset(allowed)
+
 def is_sender_allowed_for_service(sender: str, service: models.Service) -> bool:
     """
     Гибкая и надежная проверка отправителя.
@@ -301,32 +548,21 @@ def is_sender_allowed_for_service(sender: str, service: models.Service) -> bool:
     if not service:
         return False
 
-    allowed_senders_raw = service.allowed_senders or ""
-    
-    # Если в поле стоит одна звездочка, сервис "всеядный" - разрешаем всё.
-    if allowed_senders_raw.strip() == '*':
+    allowed_set = _allowed_senders_set(service.allowed_senders or "", service.name or "")
+    if allowed_set is None:
         return True
-    
-    # 1. Нормализуем имя пришедшего отправителя: убираем пробелы, нижний регистр.
-    #    Пример: "Google OTP" -> "googleotp"
-    normalized_sender = "".join(sender.lower().split())
+
+    normalized_sender = _normalize_sender(sender or "")
     if not normalized_sender:
         return False
-
-    # 2. Нормализуем список разрешенных отправителей из базы данных.
-    if allowed_senders_raw:
-        # Пример: "GoogleOTP, Google OTP" -> {"googleotp"}
-        allowed_set = {"".join(s.lower().split()) for s in allowed_senders_raw.split(',') if s.strip()}
-        if normalized_sender in allowed_set:
-            return True
-
-    # 3. Fallback: если списка нет, проверяем по основному имени сервиса (тоже нормализованному)
-    normalized_service_name = "".join((service.name or "").lower().split())
-    return normalized_sender == normalized_service_name
+    return normalized_sender in allowed_set
 # =================================================================
 # >>> КОНЕЦ ОБНОВЛЕННОЙ ЛОГИКИ <<<
 # =================================================================
 
+# паузы повторного поиска сессии, когда API ещё создаёт её (флаг pending_session в Redis)
+_PENDING_RETRY_DELAYS = (0.05, 0.1, 0.15)
+
 def _handle_deliver_sm(pdu, db: SASession, ctx: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     try:
         src, dst_raw = _extract_src_dst(pdu)
@@ -334,9 +570,12 @@ def _handle_deliver_sm(pdu, db: SASession, ctx: Optional[Dict[str, Any]] = None)
         log.exception("[WORKЕР] Ошибка извлечения src/dst: %s", e)
         return {"status": ESME_RSYSERR, "is_orphan": False}
 
+    # кандидаты номера (phonenumbers.parse) считаем один раз: и для поиска, и для ключа pending_session
+    candidates: Tuple[str, ...] = ()
     sess = None
     try:
-        sess = _find_active_session(db, dst_raw)
+        candidates = _phone_candidates(dst_raw) if dst_raw else ()
+        sess = _find_active_session(db, dst_raw, candidates)
     except Exception as e:
         log.exception("[WORKЕР] Ошибка поиска сессии: %s", e)
         try: db.rollback()
@@ -345,13 +584,18 @@ def _handle_deliver_sm(pdu, db: SASession, ctx: Optional[Dict[str, Any]] = None)
 
     try:
         if not sess and redis_client:
-            candidates = build_phone_candidates(dst_raw) or []
             norm_plus = next((c for c in candidates if c.startswith('+')), None)
             if norm_plus and redis_client.exists(f"pending_session:{norm_plus}"):
-                log.info("Гонка: %s в pending_session — ждём 200мс и повторяем поиск...", norm_plus)
-                time.sleep(0.2)
-                db.expire_all()
-                sess = _find_active_session(db, dst_raw)
+                log.info("Гонка: %s в pending_session — повторяем поиск с нарастающей паузой...", norm_plus)
+                for delay in _PENDING_RETRY_DELAYS:
+                    # до этого места сообщение в БД ничего не писало: rollback лишь закрывает транзакцию,
+                    # коннект на время паузы возвращается в пул, а повтор идёт в новой транзакции
+                    # (expire_all не нужен — identity map этого сообщения пуст)
+                    db.rollback()
+                    time.sleep(delay)
+                    sess = _find_active_session(db, dst_raw, candidates)
+                    if sess:
+                        break
     except Exception:
         pass
 
@@ -361,32 +605,36 @@ def _handle_deliver_sm(pdu, db: SASession, ctx: Optional[Dict[str, Any]] = None)
         log.exception("[WORKЕР] Ошибка сборки/декода: %s", e)
         text, is_complete = ("", True)
 
+    # src/dst/text отдаём вызывающему для лога: повторный декод PDU снаружи
+    # заново положил бы часть в буфер конкатенации
+    info = {"src": src, "dst": dst_raw, "text": text}
+
     if sess:
         if is_sender_allowed_for_service(src, sess.service):
             # Отправитель разрешен! Обрабатываем как "наше" SMS.
             if is_complete:
                 ok = _store_sms_for_session(db, sess, src, text)
-                return {"status": ESME_ROK if ok else ESME_RSYSERR, "is_orphan": False}
-            return {"status": ESME_ROK, "is_orphan": False}
+                return {"status": ESME_ROK if ok else ESME_RSYSERR, "is_orphan": False, **info}
+            return {"status": ESME_ROK, "is_orphan": False, **info}
         else:
             # Отправитель НЕ разрешен! Считаем SMS "осиротевшим".
             service_name = sess.service.name if sess.service else "N/A"
             log.warning(
-                f"SENDER MISMATCH: SMS от '{src}' для номера {dst_raw} "
-                f"не разрешен для сервиса '{service_name}' (ID сессии: {sess.id}). "
-                f"СМС будет отклонено."
+                "SENDER MISMATCH: SMS от '%s' для номера %s не разрешен для сервиса '%s' "
+                "(ID сессии: %s). СМС будет отклонено.",
+                src, dst_raw, service_name, sess.id,
             )
             if is_complete:
-                _store_orphan(db, dst_raw, src, text, ctx)
-            return {"status": ESME_RSUBMITFAIL, "is_orphan": True}
+                _enqueue_orphan(db, dst_raw, src, text, ctx)
+            return {"status": ESME_RSUBMITFAIL, "is_orphan": True, **info}
 
     if is_complete:
-        ok = _store_orphan(db, dst_raw, src, text, ctx)
-        return {"status": ESME_RSUBMITFAIL if ok else ESME_RSYSERR, "is_orphan": True}
+        ok = _enqueue_orphan(db, dst_raw, src, text, ctx)
+        return {"status": ESME_RSUBMITFAIL if ok else ESME_RSYSERR, "is_orphan": True, **info}
 
     part_text = f"[PART] {text}" if text else "[PART]"
-    ok = _store_orphan(db, dst_raw, src, part_text, ctx)
-    return {"status": ESME_RSUBMITFAIL if ok else ESME_RSYSERR, "is_orphan": True}
+    ok = _enqueue_orphan(db, dst_raw, src, part_text, ctx)
+    return {"status": ESME_RSUBMITFAIL if ok else ESME_RSYSERR, "is_orphan": True, **info}
 
 def _handle_submit_sm(pdu, db: SASession, ctx: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     return _handle_deliver_sm(pdu, db, ctx)
@@ -423,10 +671,7 @@ def _bind_rx(client: smpplib.client.Client, system_id: str, password: str, syste
         log.exception("BIND RX failed: %s", e)
         return False
 
-def _safe_set_handler(client: smpplib.client.Client, *args) -> None:
-    if len(args) == 1: handler = args[0]
-    elif len(args) >= 2: handler = args[1]
-    else: return
+def _safe_set_handler(client: smpplib.client.Client, handler: Callable[[Any], None]) -> None:
     def wrapper(pdu: Any):
         try: handler(pdu)
         except Exception: log.exception("Unhandled exception in message handler")
@@ -440,20 +685,27 @@ def run_smpp_provider_loop(provider: models.Provider, stop_evt: threading.Event)
     sid, pwd, stype = provider.system_id or "", provider.password or "", provider.system_type or ""
     while not stop_evt.is_set():
         client = None
+        db = None
         try:
             log.info("[OUTBOUND] Подключаюсь к %s:%s...", host, port)
             client = smpplib.client.Client(host, port)
             client.connect()
             if not _bind_trx(client, sid, pwd, stype): raise RuntimeError("BIND failed")
+            # одна сессия на подключение; read_once() и обработчик — в этом же потоке
+            db = SessionLocal()
             def _on_msg(pdu_obj: Any) -> None:
                 if getattr(pdu_obj, "command", "").lower() != "deliver_sm": return
-                db = SessionLocal()
                 try:
                     ctx = {"provider_id": provider.id, "system_id": provider.system_id, "client_ip": None}
                     res = _handle_deliver_sm(pdu_obj, db, ctx)
+                    db.commit()
                     log.debug("[OUTBOUND] deliver_sm handled: %s", res)
-                finally: db.close()
-            _safe_set_handler(client, "message_received", _on_msg)
+                except Exception:
+                    try: db.rollback()
+                    except Exception: pass
+                    raise
+                finally: db.expunge_all()
+            _safe_set_handler(client, _on_msg)
             last_any_io = time.time()
             while not stop_evt.is_set():
                 if client.read_once(): last_any_io = time.time()
@@ -464,6 +716,9 @@ def run_smpp_provider_loop(provider: models.Provider, stop_evt: threading.Event)
         except Exception as e:
             log.error("[OUTBOUND] Ошибка в главном цикле: %s", e, exc_info=False)
         finally:
+            if db is not None:
+                try: db.close()
+                except Exception: pass
             try:
                 if client:
                     try: client.unbind()
@@ -474,24 +729,18 @@ def run_smpp_provider_loop(provider: models.Provider, stop_evt: threading.Event)
                 log.info("[OUTBOUND] Пауза 5 секунд перед переподключением.")
                 time.sleep(5)
 
-def _gc_concat_loop():
-    while not _gc_stop.is_set():
-        now = time.time()
-        with _concat_lock:
-            keys, buf = list(_concat_buf.keys()), _concat_buf
-            for k in keys:
-                if now - (buf.get(k) or {}).get("ts", 0) > _CONCAT_TTL_SEC:
-                    buf.pop(k, None)
-        _gc_stop.wait(10.0)
-
 def start_concatenation_worker():
-    global _gc_thread
-    if _gc_thread and _gc_thread.is_alive(): return
-    _gc_stop.clear()
-    _gc_thread = threading.Thread(target=_gc_concat_loop, name="concat-gc", daemon=True)
-    _gc_thread.start()
+    # буфер конкатенации чистится лениво (_store_concat_piece); поток нужен только писателю сирот
+    global _orphan_thread
+    try:
+        warm_country_cache()
+    except Exception as e:
+        log.warning("Справочник стран не прогрет, загрузится при первой сироте: %s", e)
+    if not (_orphan_thread and _orphan_thread.is_alive()):
+        _orphan_thread = threading.Thread(target=_orphan_writer_loop, name="orphan-writer", daemon=True)
+        _orphan_thread.start()
 
 def stop_concatenation_worker():
-    _gc_stop.set()
-    if _gc_thread and _gc_thread.is_alive():
-        _gc_thread.join(timeout=1.0)
\ No newline at end of file
+    if _orphan_thread and _orphan_thread.is_alive():
+        _orphan_queue.put(None)  # писатель допишет накопленное и выйдет
+        _orphan_thread.join(timeout=5.0)
\ No newline at end of file
@@ -5,6 +5,8 @@ import re
 from phonenumbers import NumberParseException
 from typing import List, Set
 
+_NON_DIGITS_RE = re.compile(r'\D+')
+
 def normalize_phone_number(phone: str, region_hint: str = "RU") -> str:
     """
     Нормализация к E.164 (+79991234567).
@@ -25,7 +27,7 @@ def normalize_phone_number(phone: str, region_hint: str = "RU") -> str:
         pass
 
     # --- Попытка 2: Простая нормализация ---
-    digits = re.sub(r'\D+', '', phone)
+    digits = _NON_DIGITS_RE.sub('', phone)
     if digits:
         return f"+{digits}"
 
@@ -41,7 +43,7 @@ def build_phone_candidates(phone_raw: str) -> List[str]:
     Порядок важен: сначала самый "правильный" вариант.
     """
     s = (phone_raw or "").strip()
-    digits = re.sub(r'\D+', '', s)
+    digits = _NON_DIGITS_RE.sub('', s)
     cands: List[str] = []
 
     # 1) Попытка получить корректный E.164